@@ -0,0 +1,67 @@
+""" COPYRIGHT Cisco Systems, Inc. 2015
+Compares the scheduling strategies in scheduling.py by the number of VMs
+they boot, how many of those are predicted to miss the deadline, the
+predicted makespan and how full the VMs are. Running
+'./benchmark_scheduling.py' benchmarks a few synthetic catalogs, and
+'./benchmark_scheduling.py real' additionally benchmarks every file in the
+index store, using the predictor to estimate transcode times.
+"""
+import random
+import time
+import sys
+from scheduling import STRATEGIES, schedule_jobs
+
+
+def synthetic_catalog(num_files, median, seed=0):
+    """ Generates a catalog of (filename, predicted time) pairs with
+    log-normally distributed times, which is roughly what a catalog of mostly
+    short clips and a few long videos looks like
+    """
+    rand = random.Random(seed)
+    return [('synthetic%d.mp4' % i, median * rand.lognormvariate(0, 1))
+            for i in range(num_files)]
+
+
+def real_catalog():
+    """ Predicts the transcode time of every file in the index store """
+    from ingest import read_index
+    from predictor import predict_many
+
+    index = read_index()
+    filenames = sorted(index)
+    return zip(filenames, predict_many(filenames, index=index))
+
+
+def benchmark(name, jobs, capacity):
+    """ Schedules a catalog with each strategy and prints how they compare """
+    if not jobs:
+        print '%s: no files to schedule' % name
+        print
+        return
+
+    print '%s: %d files, %.0f seconds of work, %.0f second deadline' % \
+        (name, len(jobs), sum(t for f, t in jobs), capacity)
+    print '    %-8s %6s %6s %12s %12s %10s' % \
+        ('strategy', 'VMs', 'late', 'makespan (s)', 'utilization', 'time (ms)')
+    for strategy in sorted(STRATEGIES):
+        start = time.time()
+        workloads, completion_times = schedule_jobs(jobs, capacity, strategy)
+        elapsed = (time.time() - start) * 1000
+        late = len([t for t in completion_times if t > capacity])
+        utilization = sum(completion_times) / (len(workloads) * capacity)
+        print '    %-8s %6d %6d %12.0f %11.1f%% %10.1f' % \
+            (strategy, len(workloads), late, max(completion_times),
+             utilization * 100, elapsed)
+    print
+
+
+if __name__ == '__main__':
+    for num_files, median, capacity in [(100, 300, 3600),
+                                        (1000, 300, 3600),
+                                        (1000, 60, 600),
+                                        (5000, 600, 7200)]:
+        benchmark('Synthetic', synthetic_catalog(num_files, median),
+                  capacity)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'real':
+        benchmark('Real', real_catalog(), 3600)
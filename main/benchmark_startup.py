@@ -0,0 +1,110 @@
+""" COPYRIGHT Cisco Systems, Inc. 2015
+Measures how long the entry points take to import, which is the startup cost
+paid by every run before anything useful happens. Each module is imported in
+a fresh interpreter several times and the best time is reported, minus the
+time the interpreter takes to start on its own. If the interpreter supports
+'-X importtime' (Python 3.7 and up), the slowest imports under each module
+are listed as well.
+
+Running './benchmark_startup.py' benchmarks with the current interpreter,
+and './benchmark_startup.py path/to/python' with another one.
+"""
+import subprocess
+import time
+import sys
+import os
+
+# Modules that are run or imported directly as entry points
+ENTRY_POINTS = ['main', 'scheduling', 'predictor', 'ingest', 'manager']
+
+# Number of times each import is timed, keeping the fastest
+REPEATS = 5
+
+# Number of slowest imports listed per module with '-X importtime'
+SLOWEST = 5
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run(python, args):
+    """ Runs the interpreter with the given arguments in this directory, and
+    returns its exit code and stderr
+    """
+    process = subprocess.Popen([python] + args, cwd=HERE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return process.returncode, stderr
+
+
+def time_command(python, code):
+    """ Best wall clock time in seconds of running code in a fresh
+    interpreter, or None if it fails
+    """
+    best = None
+    for i in range(REPEATS):
+        start = time.time()
+        returncode, stderr = run(python, ['-c', code])
+        elapsed = time.time() - start
+        if returncode != 0:
+            return None
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def supports_importtime(python):
+    """ Whether the interpreter reports import times with '-X importtime' """
+    returncode, stderr = run(python, ['-X', 'importtime', '-c', 'import os'])
+    return returncode == 0 and 'import time:' in stderr
+
+
+def import_times(python, code):
+    """ Runs code with '-X importtime' and returns the cumulative time in
+    microseconds of every module it imported, keyed by name
+    """
+    returncode, stderr = run(python, ['-X', 'importtime', '-c', code])
+    times = dict()
+    for line in stderr.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3:
+            continue
+        try:
+            times[fields[2].strip()] = int(fields[1])
+        except ValueError:
+            continue
+    return times
+
+
+def slowest_imports(python, module, count=SLOWEST):
+    """ The count imports with the highest cumulative time when importing
+    module, as (microseconds, name) pairs. Modules the interpreter imports
+    on its own at startup are left out
+    """
+    startup = import_times(python, 'pass')
+    times = import_times(python, 'import ' + module)
+    imports = [(cumulative, name) for name, cumulative in times.items()
+               if name != module and name not in startup]
+    return sorted(imports, reverse=True)[:count]
+
+
+if __name__ == '__main__':
+    python = sys.argv[1] if len(sys.argv) > 1 else sys.executable
+    importtime = supports_importtime(python)
+    baseline = time_command(python, 'pass')
+
+    print 'Interpreter startup: %.0f ms' % (baseline * 1000)
+    print '    %-12s %12s' % ('module', 'import (ms)')
+    for module in ENTRY_POINTS:
+        elapsed = time_command(python, 'import ' + module)
+        if elapsed is None:
+            print '    %-12s %12s' % (module, 'failed')
+            continue
+
+        print '    %-12s %12.0f' % (module, (elapsed - baseline) * 1000)
+        if importtime:
+            for cumulative, name in slowest_imports(python, module):
+                print '        %-40s %8.0f' % (name, cumulative / 1000.0)
+
+    if not importtime:
+        print
+        print 'This interpreter does not support -X importtime, so only the ' \
+            'total import times are shown'
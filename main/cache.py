@@ -0,0 +1,114 @@
+""" COPYRIGHT Cisco Systems, Inc. 2015
+On-disk cache of transcode time predictions. A prediction only depends on
+the index entry of a file, the transcode configuration, and the predictor and
+scaler modules, so a prediction is stored under a hash of all of those. If
+the configuration or either of the modules change, the whole cache is
+invalidated the next time it is loaded.
+"""
+import hashlib
+import json
+import os
+import time
+
+
+def hash_entry(entry):
+    """ Hashes an index entry (or any other json serializable object) in a
+    way that doesn't depend on dictionary ordering
+    """
+    return hashlib.sha1(json.dumps(entry, sort_keys=True)).hexdigest()
+
+
+def hash_files(directories):
+    """ Hashes the contents of every file found in the given directories,
+    which is how the predictor and scaler modules are fingerprinted
+    """
+    sha = hashlib.sha1()
+    for directory in directories:
+        if not os.path.exists(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            sha.update(filename)
+            with open(os.path.join(directory, filename), 'rb') as f:
+                sha.update(f.read())
+    return sha.hexdigest()
+
+
+def model_signature(config, model_directories=('predictor', 'scaler')):
+    """ Returns the hash of the transcode config and the predictor and scaler
+    modules. Any change to these means every cached prediction is stale
+    """
+    return hash_entry([hash_entry(config), hash_files(model_directories)])
+
+
+class PredictionCache(object):
+    """ Maps index entries to predicted transcode times, and keeps track of
+    how many lookups hit or missed. Once max_entries is exceeded, the least
+    recently used predictions are evicted when the cache is saved.
+    """
+
+    def __init__(self, signature, cache_filename='prediction_cache.json',
+                 max_entries=100000):
+        self.signature = signature
+        self.cache_filename = cache_filename
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.entries = dict()
+
+        try:
+            with open(cache_filename, 'r') as cache_file:
+                stored = json.load(cache_file)
+            if stored.get('signature') == signature:
+                self.entries = stored['entries']
+            else:
+                print 'Transcode config or models changed, invalidating', \
+                    'prediction cache'
+        # A missing or corrupt cache is treated the same as an empty one
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def key(self, entry):
+        """ Cache key for an index entry under the current signature """
+        return hash_entry([self.signature, entry])
+
+    def get(self, entry):
+        """ Returns the cached prediction for an index entry, or None """
+        cached = self.entries.get(self.key(entry))
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        cached['used'] = time.time()
+        return cached['time']
+
+    def put(self, entry, time_est):
+        """ Stores the prediction for an index entry """
+        self.entries[self.key(entry)] = {'time': float(time_est),
+                                         'used': time.time()}
+
+    def evict(self):
+        """ Drops the least recently used predictions until the cache is
+        no bigger than max_entries
+        """
+        overflow = len(self.entries) - self.max_entries
+        if overflow > 0:
+            by_use = sorted(self.entries, key=lambda k: self.entries[k]['used'])
+            for key in by_use[:overflow]:
+                del self.entries[key]
+
+    def save(self):
+        """ Evicts if needed and writes the cache to disk. The cache is
+        written to a temporary file first so an interrupted save can't leave
+        a half written cache behind
+        """
+        self.evict()
+        tmp_filename = self.cache_filename + '.tmp'
+        with open(tmp_filename, 'w') as cache_file:
+            json.dump({'signature': self.signature, 'entries': self.entries},
+                      cache_file)
+        os.rename(tmp_filename, self.cache_filename)
+
+    def stats(self):
+        """ Human readable summary of the cache hit rate """
+        return 'Prediction cache: %d hits, %d misses, %d entries' % \
+            (self.hits, self.misses, len(self.entries))
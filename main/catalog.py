@@ -0,0 +1,125 @@
+""" COPYRIGHT Cisco Systems, Inc. 2015
+Cached catalog of the flavors and images of each cloud. Flavors and images
+hardly ever change, so each is listed at most once per run, and the listings
+are kept in catalog.json so later runs can skip the API calls altogether
+until they are older than CATALOG_TTL seconds (set per cloud in local.json
+and remote.json).
+
+Worker flavors are chosen by their predicted transcode throughput per unit
+of cost. The transcode time predictions are made for the 4GB RAM / 2 vCPU
+VMs TransBurst was built around, and a flavor with more vCPUs is assumed to
+speed ffmpeg up by slightly less than the ratio of vCPUs. FLAVOR_PRICES in
+local.json or remote.json gives the price of each flavor by name, e.g.
+{"m1.medium": 0.07, "m1.large": 0.14}. Flavors missing from it are assumed
+to cost in proportion to their size, as on most clouds.
+
+The catalog is stored in catalog.json, in the form: {
+                                    'local': {'flavors': {'fetched': time,
+                                                          'items': [...]},
+                                              'images': {...}},
+                                    'remote': {...}
+                                  }
+"""
+from threading import Lock
+import time
+from state import load_state, save_state
+
+CATALOG_FILENAME = 'catalog.json'
+DEFAULT_CATALOG_TTL = 3600
+
+# Smallest VM a worker runs on, which the predictions are made for
+BASE_RAM = 4096
+BASE_VCPUS = 2
+
+# How well ffmpeg scales with vCPUs. 1.0 would be perfectly linear
+SCALING_EXPONENT = 0.8
+
+# Listings already made in this run, keyed by cloud and then by kind
+catalogs = dict()
+catalog_lock = Lock()
+
+
+def cached_listing(loc, kind, fetch, ttl=DEFAULT_CATALOG_TTL,
+                   catalog_filename=CATALOG_FILENAME):
+    """ Returns a listing of the given kind for a cloud. It is taken from
+    this run if it has been made already, then from catalog.json if it is
+    younger than ttl, and is only fetched from the cloud with fetch()
+    otherwise
+    """
+    with catalog_lock:
+        entry = catalogs.get(loc, {}).get(kind)
+        if entry is None:
+            catalog = load_state(catalog_filename)
+            entry = catalog.get(loc, {}).get(kind)
+            if entry is None or time.time() - entry['fetched'] > ttl:
+                entry = {'fetched': time.time(), 'items': fetch()}
+                catalog.setdefault(loc, {})[kind] = entry
+                save_state(catalog, catalog_filename)
+            catalogs.setdefault(loc, {})[kind] = entry
+        return entry['items']
+
+
+def list_flavors(nova_client, loc, ttl=DEFAULT_CATALOG_TTL):
+    """ Returns the flavors of a cloud as dictionaries with their id, name,
+    RAM in MB and number of vCPUs
+    """
+    def fetch():
+        return [{'id': flavor.id, 'name': flavor.name, 'ram': flavor.ram,
+                 'vcpus': flavor.vcpus}
+                for flavor in nova_client.flavors.list()]
+    return cached_listing(loc, 'flavors', fetch, ttl)
+
+
+def list_images(glance_client, loc, ttl=DEFAULT_CATALOG_TTL):
+    """ Returns the images of a cloud as dictionaries with their id and name
+    """
+    def fetch():
+        return [{'id': image.id, 'name': image.name}
+                for image in glance_client.images.list()]
+    return cached_listing(loc, 'images', fetch, ttl)
+
+
+def flavor_speedup(flavor):
+    """ Predicted transcode throughput of a flavor, relative to the base VM
+    """
+    return (float(flavor['vcpus']) / BASE_VCPUS) ** SCALING_EXPONENT
+
+
+def speedup_of(nova_client, loc, flavor_id, ttl=DEFAULT_CATALOG_TTL):
+    """ flavor_speedup of a cloud's flavor given its id, or 1.0 if there is
+    no such flavor
+    """
+    for flavor in list_flavors(nova_client, loc, ttl):
+        if flavor['id'] == flavor_id:
+            return flavor_speedup(flavor)
+    return 1.0
+
+
+def flavor_price(flavor, prices):
+    """ Price of a flavor from the given prices, or its size relative to the
+    base VM if it has no price
+    """
+    if flavor['name'] in prices:
+        return float(prices[flavor['name']])
+    return max(float(flavor['vcpus']) / BASE_VCPUS,
+               float(flavor['ram']) / BASE_RAM)
+
+
+def best_flavor(flavors, prices=None, min_ram=BASE_RAM,
+                min_vcpus=BASE_VCPUS):
+    """ Picks the flavor with the most predicted throughput per unit of cost
+    out of those big enough to run a worker, preferring the smaller one on a
+    tie. Returns None if no flavor is big enough
+    """
+    prices = prices or dict()
+    candidates = [flavor for flavor in flavors
+                  if flavor['ram'] >= min_ram and
+                  flavor['vcpus'] >= min_vcpus and
+                  flavor_price(flavor, prices) > 0]
+    if not candidates:
+        return None
+
+    return max(candidates,
+               key=lambda flavor: (flavor_speedup(flavor) /
+                                   flavor_price(flavor, prices),
+                                   -flavor['ram'], -flavor['vcpus']))
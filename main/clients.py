@@ -1,22 +1,65 @@
 """ COPYRIGHT Cisco Systems, Inc. 2015
-A collection of function that spawn Python OpenStack clients """
+A collection of function that spawn Python OpenStack clients
+
+All clients for the same credentials share one keystone session, so the
+program authenticates once per cloud, and the token is reused (and renewed
+when it expires) by every nova and glance client made from it. Swift clients
+start out with the session's token, and authenticate again on their own once
+it expires. Swift connections are not thread safe, so code that talks to
+swift from several threads borrows connections from a SwiftPool instead of
+sharing one.
+"""
 import keystoneclient.v2_0.client as keystone_client
 from keystoneclient import session
 from keystoneclient.auth.identity import v2
 import glanceclient.v2.client as glance_client
 from novaclient import client as nova_client
 from swiftclient import Connection
+from contextlib import contextmanager
+from threading import Lock, Semaphore
+from Queue import Queue, Empty
+
+# Default number of swift connections a SwiftPool keeps open at once
+SWIFT_POOL_SIZE = 8
+
+# Keystone sessions, keyed by the cloud and user they authenticate
+sessions = dict()
+sessions_lock = Lock()
+
+# SwiftPools made by get_swift_pool, keyed the same way
+swift_pools = dict()
+swift_pools_lock = Lock()
+
+
+def credentials_key(credentials):
+    """ Identifies the cloud, user and tenant of a credentials dictionary """
+    return (credentials["OS_AUTH_URL"], credentials["OS_USERNAME"],
+            credentials["OS_TENANT_NAME"])
+
+
+def create_session(credentials):
+    """ Returns the keystone session for a credentials dictionary, creating
+    it the first time. The session authenticates lazily, caches its token and
+    keeps its HTTP connections alive between requests
+    """
+    key = credentials_key(credentials)
+    with sessions_lock:
+        if key not in sessions:
+            auth = v2.Password(auth_url=credentials["OS_AUTH_URL"],
+                               username=credentials["OS_USERNAME"],
+                               password=credentials["OS_PASSWORD"],
+                               tenant_name=credentials["OS_TENANT_NAME"])
+            sessions[key] = session.Session(auth=auth)
+        return sessions[key]
 
 
 def create_keystone_client(credentials):
     """ Spawns keystone client based of a credentials dictionary passed to
     the function
     """
-    keystone = keystone_client.Client(auth_url=credentials["OS_AUTH_URL"],
-                                      username=credentials["OS_USERNAME"],
-                                      password=credentials["OS_PASSWORD"],
-                                      tenant_name=credentials["OS_TENANT_NAME"],
-                                      region_name=credentials["OS_REGION_NAME"])
+    sess = create_session(credentials)
+    keystone = keystone_client.Client(
+        session=sess, region_name=credentials["OS_REGION_NAME"])
     return keystone
 
 
@@ -24,34 +67,116 @@ def create_nova_client(credentials):
     """ Spawns nova client based of a credentials dictionary passed to the
     function
     """
-    auth = v2.Password(auth_url=credentials["OS_AUTH_URL"],
-                       username=credentials["OS_USERNAME"],
-                       password=credentials["OS_PASSWORD"],
-                       tenant_name=credentials["OS_TENANT_NAME"])
-
-    sess = session.Session(auth=auth)
-    nova = nova_client.Client("2", session=sess)
+    nova = nova_client.Client("2", session=create_session(credentials))
     return nova
 
 
 # Note: A swift endpoint is required for creating a swift client
 def create_swift_client(credentials):
     """ Spawns swift client based of a credentials dictionary passed to the
-    function
+    function. The client starts out with the storage URL and token of the
+    shared session, so it doesn't authenticate again, but it keeps the
+    credentials so it can if the token expires
     """
+    sess = create_session(credentials)
     swift = Connection(user=credentials["OS_USERNAME"],
                        key=credentials["OS_PASSWORD"],
                        authurl=credentials["OS_AUTH_URL"],
                        tenant_name=credentials["OS_TENANT_NAME"],
-                       auth_version="2.0")
+                       auth_version="2.0",
+                       preauthurl=sess.get_endpoint(
+                           service_type='object-store'),
+                       preauthtoken=sess.get_token())
 
     return swift
 
 
-def create_glance_client(keystone_client):
-    """ Spawns a glance client based from a keystone client passed to it """
-    glance_endpoint = keystone_client.service_catalog.url_for(
-        service_type='image')
-    glance = glance_client.Client(endpoint=glance_endpoint,
-                                  token=keystone_client.auth_token)
+def create_glance_client(credentials):
+    """ Spawns a glance client based of a credentials dictionary passed to
+    the function
+    """
+    glance = glance_client.Client(session=create_session(credentials))
     return glance
+
+
+class SwiftPool(object):
+    """ Thread safe pool of swift connections. Connections are made by
+    calling factory, at most size of them are in use at once, and each one
+    goes back into the pool after use so its HTTP connection is kept alive
+    for the next request. Use it as:
+
+        with swift_pool.connection() as swift:
+            swift.put_object(...)
+    """
+
+    def __init__(self, factory, size=SWIFT_POOL_SIZE):
+        self.factory = factory
+        self.idle = Queue()
+        self.size = size
+        self.slots = Semaphore(size)
+        self.lock = Lock()
+
+    def grow(self, size):
+        """ Lets up to size connections be in use at once, if that is more
+        than the pool allows already
+        """
+        with self.lock:
+            for i in range(size - self.size):
+                self.slots.release()
+            self.size = max(self.size, size)
+
+    @contextmanager
+    def connection(self):
+        """ Lends out a connection, waiting if size are already in use. A
+        connection that raised an error is not put back, in case it was left
+        in a bad state
+        """
+        self.slots.acquire()
+        try:
+            try:
+                swift = self.idle.get_nowait()
+            except Empty:
+                swift = self.factory()
+            yield swift
+            self.idle.put(swift)
+        finally:
+            self.slots.release()
+
+
+def get_swift_pool(credentials, size=None):
+    """ Returns the SwiftPool for a credentials dictionary, shared by
+    everything in this process that uses the same credentials. If a size is
+    given, the pool is grown to allow at least that many connections at once
+    """
+    key = credentials_key(credentials)
+    with swift_pools_lock:
+        if key not in swift_pools:
+            swift_pools[key] = SwiftPool(
+                lambda: create_swift_client(credentials),
+                size or SWIFT_POOL_SIZE)
+        elif size:
+            swift_pools[key].grow(size)
+        return swift_pools[key]
+
+
+class LazyClients(object):
+    """ The clients for one cloud, looked up by service like a dictionary
+    ('nova', 'glance' or 'swift'). Each client is only created the first
+    time it is looked up, so a run that never needs a service never connects
+    to it
+    """
+    factories = {'nova': create_nova_client,
+                 'glance': create_glance_client,
+                 'swift': create_swift_client}
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.clients = dict()
+        self.lock = Lock()
+
+    def __getitem__(self, service):
+        with self.lock:
+            if service not in self.clients:
+                self.clients[service] = \
+                    self.factories[service](self.credentials)
+            return self.clients[service]
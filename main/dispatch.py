@@ -0,0 +1,168 @@
+""" COPYRIGHT Cisco Systems, Inc. 2015
+Pull based job dispatch and completion notifications. Rather than handing
+each worker a fixed workload up front, the manager keeps a central queue of
+jobs for each cloud, and workers ask for the next job whenever they have room
+for one. Jobs are handed out longest predicted first, so when a prediction
+is off, the workers that finish early just take more of the remaining short
+jobs.
+
+Workers pull from 'GET /jobs/next?queue=<queue>&worker=<id>' on the manager,
+which answers with the next filename, or an empty 204 once the queue is
+drained.
+
+Workers also 'POST /events' to the manager with a json body whenever they
+place a file back in swift ({'event': 'job', ...}) and once they have
+finished all of their work ({'event': 'workload', ...}). These are recorded
+by a CompletionTracker, which the manager waits on instead of polling every
+worker. The manager must be reachable from the workers at MANAGER_URL in
+local.json for either of these.
+"""
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from threading import Thread, Lock, Condition
+from heapq import heappush, heappop
+from urlparse import parse_qs
+import json
+import time
+
+# Port the manager listens on for workers
+DISPATCH_PORT = 5001
+
+
+class JobQueue(object):
+    """ Thread safe queue of filenames ordered by predicted transcode time,
+    longest first
+    """
+
+    def __init__(self, jobs=()):
+        self.lock = Lock()
+        self.heap = []
+        for filename, time_est in jobs:
+            self.put(filename, time_est)
+
+    def put(self, filename, time_est):
+        """ Adds a file with its predicted transcode time """
+        with self.lock:
+            heappush(self.heap, (-time_est, filename))
+
+    def get(self):
+        """ Returns the longest remaining file, or None if there are none """
+        with self.lock:
+            if not self.heap:
+                return None
+            return heappop(self.heap)[1]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap)
+
+
+class CompletionTracker(object):
+    """ Keeps track of the completion events sent by workers, and lets the
+    manager wait for a set of workers to finish. Functions added to
+    job_callbacks are called with every job event as it comes in.
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.finished = set()
+        self.job_callbacks = []
+
+    def record(self, event):
+        """ Records an event POSTed by a worker """
+        if event.get('event') == 'job':
+            print 'Worker %s placed %s' % (event.get('worker'),
+                                           event.get('output'))
+            for callback in self.job_callbacks:
+                callback(event)
+        elif event.get('event') == 'workload':
+            print 'Worker %s finished its workload' % event.get('worker')
+            with self.condition:
+                self.finished.add(event.get('worker'))
+                self.condition.notify_all()
+
+    def wait(self, worker_ids, timeout):
+        """ Waits up to timeout seconds for all of the given workers to
+        finish. Returns whether they all did
+        """
+        worker_ids = set(worker_ids)
+        give_up = time.time() + timeout
+        with self.condition:
+            while not worker_ids <= self.finished:
+                remaining = give_up - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+
+class DispatchHandler(BaseHTTPRequestHandler):
+    """ Handles the requests workers make to the manager """
+
+    def do_GET(self):
+        path, x, query = self.path.partition('?')
+        params = parse_qs(query)
+        if path != '/jobs/next':
+            self.send_error(404)
+            return
+
+        queue = self.server.queues.get(params.get('queue', [''])[0])
+        job = queue.get() if queue else None
+        if job is None:
+            self.send_response(204)
+            self.end_headers()
+            return
+
+        print 'Dispatching %s to worker %s' % \
+            (job, params.get('worker', ['?'])[0])
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(job)
+
+    def do_POST(self):
+        if self.path != '/events':
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            event = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+
+        self.server.tracker.record(event)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        """ The prints in the handlers are enough, so the default access log
+        is silenced
+        """
+        pass
+
+
+class DispatchServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server holding one JobQueue per cloud, keyed by name, and the
+    CompletionTracker for the events workers send
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=DISPATCH_PORT):
+        HTTPServer.__init__(self, ('', port), DispatchHandler)
+        self.queues = dict()
+        self.tracker = CompletionTracker()
+
+
+def start_dispatcher(port=DISPATCH_PORT):
+    """ Starts the dispatch server in a background thread and returns it.
+    Call shutdown() on it to stop it
+    """
+    server = DispatchServer(port)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print 'Dispatcher listening on port %d' % port
+    return server
@@ -3,6 +3,9 @@ This file will ingest all .mp4 and .mkv files in a given directory when
 run, although it can also be imported into other files and run from there.
 The default directory is the directory ingest.py is run from, but this can be
 changed using a command line argument: './ingest.py ingest/directory/path'.
+An optional second argument gives the number of processes to probe files
+with, in which case files are probed and uploaded in parallel:
+'./ingest.py ingest/directory/path 8'.
 Files are also by default put into the local swift storage, although this can
 be changed as well
 """
@@ -10,65 +13,164 @@ import subprocess
 import json
 import os
 import sys
-from converter import Converter
-from clients import create_swift_client
-
-
-def find_num_frames(frame_type, filename):
-    """Find and return the number of frames of a given type
-    Valid frame_types are 'I', 'P', and 'B'.
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore
+from clients import get_swift_pool
+from move import upload
+import store
+
+
+def parse_fps(rate):
+    """ ffprobe reports frame rates as fractions such as '30000/1001' """
+    numerator, x, denominator = rate.partition('/')
+    if denominator and float(denominator) != 0.0:
+        return float(numerator) / float(denominator)
+    return float(numerator)
+
+
+def probe(filename):
+    """ Probes a file with a single ffprobe call, which decodes the file once
+    to count the I, P and B frames and also reports the format and stream
+    metadata. The ffprobe output is read line by line as it is produced, so
+    nothing but the counts is kept in memory. Returns a dictionary of the form
+    {'frames': {'I': #, 'P': #, 'B': #}, 'format': {...}, 'streams': [...]}
     """
-    print 'Finding number of', frame_type, 'frames for', filename
-    command = ('ffprobe -loglevel quiet -show_frames ' + filename + ' | ' +
-               'grep pict_type=' + frame_type + ' | wc -l')
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-    return int(process.stdout.read())
-
-
-def ingest(credentials, directory):
+    print 'Probing', filename
+    command = ['ffprobe', '-loglevel', 'quiet', '-print_format', 'compact',
+               '-show_entries',
+               'frame=pict_type:'
+               'stream=codec_type,codec_name,width,height,r_frame_rate:'
+               'format=format_name,duration',
+               filename]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    info = {'frames': {'I': 0, 'P': 0, 'B': 0}, 'format': {}, 'streams': []}
+    for line in process.stdout:
+        # Each line looks like 'section|key=value|key=value'
+        fields = line.strip().split('|')
+        section = fields[0]
+        values = dict(field.partition('=')[::2] for field in fields[1:])
+
+        if section == 'frame':
+            pict_type = values.get('pict_type')
+            if pict_type in info['frames']:
+                info['frames'][pict_type] += 1
+        elif section == 'stream':
+            info['streams'].append(values)
+        elif section == 'format':
+            info['format'] = values
+
+    if process.wait() != 0:
+        raise IOError('ffprobe failed on ' + filename)
+    return info
+
+
+def ingest(credentials, directory, num_workers=1, num_uploaders=4):
     """ Ingest all .mp4 and .mkv files in a given directory. More details on
-    ingesting found in the ingest function
+    ingesting found in the ingest_file function. If num_workers is more than
+    1, files are ingested in parallel, see parallel_ingest for details.
     """
     print 'Beginning ingest'
-    for filename in os.listdir(directory):
-        if filename.endswith('.mp4') or filename.endswith('.mkv'):
-            ingest_file(credentials, filename)
+    paths = [os.path.join(directory, filename)
+             for filename in os.listdir(directory)
+             if filename.endswith('.mp4') or filename.endswith('.mkv')]
+    if num_workers > 1:
+        parallel_ingest(credentials, paths, num_workers, num_uploaders)
+    else:
+        for path in paths:
+            ingest_file(credentials, path)
     print 'Finished ingesting'
 
 
 def ingest_file(credentials, filename):
     """ Ingests a given file. This means that it generates an index for this
     file with all relevant information about the file (FPS, resolution,
-    I/P/B frames, etc.) into an index file (index.json) and then moves it to
+    I/P/B frames, etc.) into the index store (index.db) and then moves it to
     a swift client specified by the credentials dictionary
     """
     print 'Ingesting file', filename
     index = generate_index(filename)
-    write_index(filename, index)
+    write_index(os.path.basename(filename), index)
     swift_move(filename, credentials)
 
 
+def index_file(filename):
+    """ Process pool target for parallel_ingest. Returns the filename along
+    with its index, since results come back in completion order
+    """
+    return filename, generate_index(filename)
+
+
+def upload_file(filename, credentials, upload_slots):
+    """ Upload pool target for parallel_ingest. Frees up a slot for the next
+    file once the upload is done, whether or not it succeeded
+    """
+    try:
+        swift_move(filename, credentials)
+    finally:
+        upload_slots.release()
+
+
+def parallel_ingest(credentials, filenames, num_workers, num_uploaders):
+    """ Ingests a list of files in parallel. Probing is CPU bound, so it is
+    done in a pool of num_workers processes, while uploading is network bound
+    and is done in a separate pool of num_uploaders threads, so the two
+    overlap. Indexes are written only from this process as probe results come
+    in, so there is a single writer to the index. The number of probed files
+    waiting to be uploaded is bounded so probing can't get too far ahead of
+    the uplink.
+    """
+    # Makes the shared swift pool big enough for every uploader at once,
+    # growing it if an earlier ingest already made a smaller one
+    get_swift_pool(credentials, num_uploaders)
+    probe_pool = Pool(num_workers)
+    upload_pool = ThreadPool(num_uploaders)
+    upload_slots = BoundedSemaphore(num_uploaders * 2)
+    uploads = []
+
+    for filename, index in probe_pool.imap_unordered(index_file, filenames):
+        write_index(os.path.basename(filename), index)
+        upload_slots.acquire()
+        uploads.append(upload_pool.apply_async(
+            upload_file, (filename, credentials, upload_slots)))
+
+    probe_pool.close()
+    probe_pool.join()
+    upload_pool.close()
+    upload_pool.join()
+
+    # Re-raises any exception that happened during an upload
+    for upload in uploads:
+        upload.get()
+
+
 def generate_index(filename):
-    """ Generates an index dictionary, using python-video-convert to access
-    ffprobe for simple attributes such as FPS or resolution, and subprocess
-    to call a ffprobe directly for finding the I/B/P frames. See
-    find_num_frames for more details on that.
+    """ Generates an index dictionary from a single ffprobe pass over the
+    file, which gives both the simple attributes such as FPS or resolution
+    and the number of I/B/P frames. See probe for more details on that.
     """
     print 'Generating index for file', filename
-    c = Converter()
-    info = c.probe(filename)
+    info = probe(filename)
+    video = dict()
+    audio = dict()
+    for stream in info['streams']:
+        if stream.get('codec_type') == 'video' and not video:
+            video = stream
+        elif stream.get('codec_type') == 'audio' and not audio:
+            audio = stream
     index = dict()
 
-    index['i frames'] = find_num_frames('I', filename)
-    index['b frames'] = find_num_frames('B', filename)
-    index['p frames'] = find_num_frames('P', filename)
-    index['duration'] = info.format.duration
-    index['width'] = info.video.video_width
-    index['height'] = info.video.video_height
-    index['format'] = info.format.format
-    index['fps'] = info.video.video_fps
-    index['v codec'] = info.video.codec
-    index['a codec'] = info.audio.codec
+    index['i frames'] = info['frames']['I']
+    index['b frames'] = info['frames']['B']
+    index['p frames'] = info['frames']['P']
+    index['duration'] = float(info['format']['duration'])
+    index['width'] = int(video['width'])
+    index['height'] = int(video['height'])
+    index['format'] = info['format']['format_name']
+    index['fps'] = parse_fps(video['r_frame_rate'])
+    index['v codec'] = video['codec_name']
+    index['a codec'] = audio.get('codec_name')
 
     return index
 
@@ -79,45 +181,41 @@ def swift_move(filename, credentials, container='videos', content_type='video'):
     use across the entire project, but they can be easily changed.
     """
     print 'Moving', filename, 'to swift'
-    swift = create_swift_client(credentials)
-
-    # Creates the container we need to use if it doesn't already exist
-    swift.put_container(container)
-    with open(filename, 'rb') as f:
-        swift.put_object(container, filename, contents=f,
-                         content_type=content_type)
-
 
-def read_index(index_filename='index.json'):
-    """ Reads in the index file, which is specified in a json file """
-    return json.load(open(index_filename))
+    # Connections are borrowed from a pool shared by every upload in this
+    # process, so each file doesn't have to connect and authenticate again
+    with get_swift_pool(credentials).connection() as swift:
+        # Creates the container we need to use if it doesn't already exist
+        swift.put_container(container)
+        upload(swift, container, filename, content_type=content_type)
 
 
-def write_index(filename, index, index_filename='index.json'):
-    """ Writes an index for a filename, using an index dictionary passed to
-    it. If a previously existing index exists, it will attempt to write it
-    there, otherwise, it will create a new index.
-
-    The index is of the form: {
+def read_index(filenames=None, index_filename='index.db'):
+    """ Reads in the index entries of the given filenames, or the whole index
+    if no filenames are given. The index is of the form: {
                                 filename1: {*attributes*}
                                 filename2: {*attributes*}
                                 ...
                               }
     """
+    index_store = store.connect(index_filename)
+    try:
+        return store.read_entries(index_store, filenames)
+    finally:
+        index_store.close()
+
+
+def write_index(filename, index, index_filename='index.db'):
+    """ Writes an index for a filename, using an index dictionary passed to
+    it. The index is kept in an SQLite store (see store.py), so each write
+    only inserts a single row instead of rewriting the whole index.
+    """
     print 'Writing index for', filename
-    # The try block attempts to write it to a previously existing index
+    index_store = store.connect(index_filename)
     try:
-        with open(index_filename, 'r') as index_file:
-            total_index = json.load(index_file)
-        total_index[filename] = index
-        with open(index_filename, 'w+') as index_file:
-            json.dump(total_index, index_file, sort_keys=True, indent=4)
-    # If there is an IOError, the index does not exist, and it must be created
-    except IOError:
-        total_index = dict()
-        total_index[filename] = index
-        with open(index_filename, 'w+') as index_file:
-            json.dump(total_index, index_file, sort_keys=True, indent=4)
+        store.write_entry(index_store, filename, index)
+    finally:
+        index_store.close()
 
 
 # Typically, ingest.py is run on its own rather than with main.py, so a main
@@ -129,4 +227,8 @@ if __name__ == '__main__':
         directory = sys.argv[1]
     else:
         directory = '.'
-    ingest(credentials, directory)
+    if len(sys.argv) > 2:
+        num_workers = int(sys.argv[2])
+    else:
+        num_workers = 1
+    ingest(credentials, directory, num_workers)
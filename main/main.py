@@ -3,89 +3,254 @@ This is main.py, the file that is actually run and orchestrates
 the process, typically after ingest.py is run. Certain parts are not
 commented, as the print statements generally sufficiently explain what is
 going on.
+
+The local and remote clouds are run as two concurrent phases. Both fleets
+are provisioned at the same time, and each fleet is torn down as soon as it
+has finished (or returned to the warm pool, see pool.py), so a run takes
+about as long as the slower of the two clouds. Clients are only created once
+they are used, so the remote cloud isn't even contacted if nothing is burst
+to it.
 """
+from multiprocessing.pool import ThreadPool
+import json
+import sys
 from scheduling import *
 from clients import *
 from manager import *
 from move import *
+from placement import plan_placement, plan_burst
+from catalog import speedup_of, DEFAULT_CATALOG_TTL
+from dispatch import start_dispatcher, JobQueue
+from pool import claim, release, DEFAULT_POOL_SIZE, DEFAULT_POOL_TTL, \
+    POOL_FILENAME
+from state import load_state
+from split import split_jobs, stitch, DEFAULT_SPLIT_FRACTION
+
+
+def create_clients(credentials):
+    """ Returns the Python OpenStack clients required to run the program on
+    one cloud, keyed by service. Each one is created the first time it is
+    used, and they all share one keystone session, so the cloud is only
+    authenticated with once, and not at all if nothing runs on it
+    """
+    return LazyClients(credentials)
+
+
+def run_fleet(clients, credentials, loc, schedule, flavor=None,
+              dispatcher_url=None, notify_url=None, tracker=None,
+              overflow=None):
+    """ Runs one cloud's phase from start to finish: gives a VM to every
+    workload in the schedule, waits for all of them to finish, and then gets
+    rid of them straight away. Idle VMs from the warm pool (see pool.py) are
+    used before any new ones are spawned, and finished VMs go back to the
+    pool if it has room for them, otherwise they are destroyed. If any VMs
+    fail to spawn, overflow is called with the workloads they were meant to
+    run, before waiting on the rest
+    """
+    nova = clients['nova']
+    pool_size = credentials.get('WARM_POOL_SIZE', DEFAULT_POOL_SIZE)
+    pool_ttl = credentials.get('WARM_POOL_TTL', DEFAULT_POOL_TTL)
+
+    warm_servers = []
+    if pool_size:
+        warm_servers = claim(nova, loc, len(schedule))
+        for num, server in enumerate(warm_servers):
+            assign_work(nova, server, loc, schedule, num, dispatcher_url,
+                        notify_url)
 
-# The default state is to run only in the local cloud, using the remote on an
-# as-needed basis
-local_only = True
-
-# Creates all needed Python OpenStack clients required to run the program for
-# the local cloud only
-local_credentials = load_credentials('config/local.json')
-local_keystone = create_keystone_client(local_credentials)
-local_glance = create_glance_client(local_keystone)
-local_swift = create_swift_client(local_credentials)
-local_nova = create_nova_client(local_credentials)
-
-# Deadline is stored in the local_credentials
-deadline = local_credentials['DEADLINE']
-
-# Determine what can be done in the allotted time
-time_remaining = time_until_deadline(deadline)
-schedule = partition(time_remaining, local_swift)
-num_instances = len(schedule)
-print 'Predicted number of instances needed: ', num_instances
-
-# Start up image on our local cloud
-local_servers = spawn(local_nova, find_flavor(local_nova),
-                      find_image(local_glance), 'local', schedule)
-
-# Determine if a remote cloud is needed
-remote_workload = []
-if len(local_servers) < num_instances:
-    # If workload cannot fit on local cloud, send the remaining workload to the
-    # remote cloud
-    local_only = False
-    remote_workload = schedule
-
-print 'Number of instances required on local cloud:', len(local_servers)
-print 'Number of instances required on remote cloud:', len(remote_workload)
-
-if not local_only:
-    # Given a deadline, workload, and a collection of data, determine
-    # which cloud to outsource to
-
-    # Creates all needed Python OpenStack clients required to run the program
-    # for the remote cloud
+    servers = warm_servers
+    if schedule:
+        if flavor is None:
+            flavor = find_flavor(nova, loc, credentials)
+        image = find_image(clients['glance'], loc=loc)
+        servers = servers + spawn(nova, flavor, image, loc, schedule,
+                                  dispatcher_url=dispatcher_url,
+                                  notify_url=notify_url)
+
+    # Whatever is left in the schedule never got a VM
+    if schedule and overflow is not None:
+        overflow(schedule)
+
+    print 'Waiting for completion signal from %s nodes...' % loc
+    wait_for_completion(nova, servers, loc, tracker)
+    print 'Received completion signal from %s nodes' % loc
+
+    release(nova, loc, servers, pool_size, pool_ttl)
+
+
+def main():
+    local_credentials = load_credentials('config/local.json')
     remote_credentials = load_credentials('config/remote.json')
-    remote_keystone = create_keystone_client(remote_credentials)
-    remote_glance = create_glance_client(remote_keystone)
-    remote_nova = create_nova_client(remote_credentials)
-    remote_swift = create_swift_client(remote_credentials)
 
-    print 'Moving data to remote cloud...'
+    # Pulling workers get their jobs from the dispatcher, which they can only
+    # reach at MANAGER_URL
+    if local_credentials.get('DISPATCH') == 'pull' and \
+            not local_credentials.get('MANAGER_URL'):
+        print '"DISPATCH": "pull" needs MANAGER_URL in local.json'
+        sys.exit(1)
+
+    local_clients = create_clients(local_credentials)
+    remote_clients = create_clients(remote_credentials)
 
-    # Find remote schedule
-    remote_list = [video for sub_list in remote_workload for video in
-                   sub_list]
+    # Deadline is stored in the local_credentials
+    deadline = local_credentials['DEADLINE']
+
+    # Determine what can be done in the allotted time
     time_remaining = time_until_deadline(deadline)
-    remote_schedule = partition(time_remaining, remote_swift,
-                                file_list=remote_list)
+    print "Time Remaining:", predictor.prettify_time(time_remaining)
+    sizes = list_videos(local_clients['swift'])
+    jobs = predict_jobs(sizes.keys())
+
+    # In split mode, files too long for one VM are cut into chunks that are
+    # scheduled as separate jobs, and stitched back together at the end
+    chunks = dict()
+    if local_credentials.get('SPLIT'):
+        # Only HLS playlists can be stitched back together
+        with open('config/transcode.json') as transcode_config:
+            output_format = json.load(transcode_config).get('format')
+        if output_format != 'm3u8':
+            print 'SPLIT needs "format": "m3u8" in transcode.json, not %s' % \
+                output_format
+            sys.exit(1)
+
+        # Imported here, as the index store is only needed in split mode
+        from ingest import read_index
+        max_job_time = local_credentials.get(
+            'SPLIT_JOB_TIME', time_remaining * DEFAULT_SPLIT_FRACTION)
+        jobs, sizes, chunks = split_jobs(jobs, read_index(sizes.keys()),
+                                         sizes, max_job_time)
+
+    # Decide how many VMs go on each cloud and which files go where, before
+    # any VM is spawned. The local cloud is used as far as its free quota
+    # (plus any idle VMs in the warm pool) allows, and whatever doesn't fit
+    # is burst to the remote cloud as cheaply as possible
+    local_flavor = find_flavor(local_clients['nova'], 'local',
+                               local_credentials)
+    local_max = find_local_max(local_clients['nova'], local_flavor)
+    if local_max is not None and \
+            local_credentials.get('WARM_POOL_SIZE', DEFAULT_POOL_SIZE):
+        local_max += len(load_state(POOL_FILENAME).get('local', []))
+
+    # The predictions are for the base VM, so they are scaled to the speed of
+    # the flavor each cloud runs. The remote cloud is only asked for its
+    # flavors if anything is burst to it, in which case the placement is made
+    # again for the speed of the remote flavor
+    local_speedup = speedup_of(
+        local_clients['nova'], 'local', local_flavor,
+        local_credentials.get('CATALOG_TTL', DEFAULT_CATALOG_TTL))
+    placement = plan_placement(jobs, sizes, time_remaining, local_max,
+                               local_credentials, remote_credentials,
+                               local_speedup=local_speedup)
+    remote_flavor = None
+    remote_speedup = 1.0
+    if placement['remote']:
+        remote_flavor = find_flavor(remote_clients['nova'], 'remote',
+                                    remote_credentials)
+        remote_speedup = speedup_of(
+            remote_clients['nova'], 'remote', remote_flavor,
+            remote_credentials.get('CATALOG_TTL', DEFAULT_CATALOG_TTL))
+        placement = plan_placement(jobs, sizes, time_remaining, local_max,
+                                   local_credentials, remote_credentials,
+                                   local_speedup=local_speedup,
+                                   remote_speedup=remote_speedup)
+    local_schedule = placement['local']
+    remote_schedule = placement['remote']
+
+    print 'Number of instances required on local cloud:', len(local_schedule)
+    print 'Number of instances required on remote cloud:', len(remote_schedule)
+
+    # If the workers can reach the manager, they push completion events to
+    # it rather than waiting to be polled
+    notify_url = None
+    tracker = None
+    if local_credentials.get('MANAGER_URL'):
+        dispatcher = start_dispatcher()
+        notify_url = local_credentials['MANAGER_URL'] + '/events'
+        tracker = dispatcher.tracker
+
+    # In pull mode, the workloads from the placement only decide how many VMs
+    # each cloud gets and which cloud each file goes to. The files themselves
+    # are handed out from a central queue per cloud, longest first, as
+    # workers free up
+    dispatcher_url = None
+    predicted = dict(jobs)
+    if local_credentials.get('DISPATCH') == 'pull':
+        dispatcher_url = local_credentials['MANAGER_URL']
+        for loc, loc_schedule in [('local', local_schedule),
+                                  ('remote', remote_schedule)]:
+            dispatcher.queues[loc] = JobQueue(
+                (video, predicted[video]) for workload in loc_schedule
+                for video in workload)
+
+    # With completion events, each transcoded file is downloaded as soon as
+    # it is back in swift, rather than all of them at the end
+    retriever = None
+    if tracker is not None:
+        retriever = retrieve_as_completed(local_clients['swift'], tracker)
+
+    # Both fleets are provisioned, run and torn down at the same time, along
+    # with a third one if any local VMs fail to spawn
+    pool = ThreadPool(3)
+    fleets = []
+
+    def burst(workloads):
+        """ Runs the local workloads that no local VM could be spawned for
+        on the remote cloud instead
+        """
+        print '%d local VMs could not be spawned. Bursting their work to ' \
+            'the remote cloud...' % len(workloads)
+        workloads = plan_burst(list(workloads), predicted, sizes,
+                               len(placement['remote_times']),
+                               remote_credentials, remote_speedup)
+        if not workloads:
+            print 'WARNING:  No remote VMs are left to burst to.'
+            return
 
-    print 'Corrected number of remote instances required:', len(remote_schedule)
+        # In pull mode, the files are moved over to the remote queue, taking
+        # as much work off the local queue as the missing VMs would have done
+        if dispatcher_url:
+            missing = sum(predicted[video] for workload in workloads
+                          for video in workload)
+            while missing > 0:
+                video = dispatcher.queues['local'].get()
+                if video is None:
+                    break
+                dispatcher.queues['remote'].put(video, predicted[video])
+                missing -= predicted[video]
 
-    # Start up the image on our remote cloud
-    remote_servers = spawn(remote_nova, find_flavor(remote_nova),
-                           find_image(remote_glance), 'remote', remote_schedule)
+        fleets.append(pool.apply_async(run_fleet, (
+            remote_clients, remote_credentials, 'remote', workloads,
+            remote_flavor, dispatcher_url, notify_url, tracker)))
 
-    print 'Waiting for completion signal from remote nodes...'
-    while not transcode_complete(remote_nova, remote_servers, 'remote'):
-        sleep(5)
-    print 'Received completion signal from remote nodes'
+    if local_schedule:
+        fleets.append(pool.apply_async(run_fleet, (
+            local_clients, local_credentials, 'local', local_schedule,
+            local_flavor,
+            dispatcher_url, notify_url, tracker, burst)))
+    if remote_schedule:
+        fleets.append(pool.apply_async(run_fleet, (
+            remote_clients, remote_credentials, 'remote',
+            remote_schedule, remote_flavor,
+            dispatcher_url, notify_url, tracker)))
 
-    kill_servers(remote_servers)
+    # Re-raises anything that went wrong in any phase. The local fleet comes
+    # first, and only returns once it has added its burst fleet to the list
+    for fleet in fleets:
+        fleet.get()
+    pool.close()
 
+    print 'Retrieving data...'
+    if retriever is not None:
+        retriever.close()
+        retriever.join()
+    retrieve(local_clients['swift'])
+    for filename, chunk_jobs in chunks.items():
+        try:
+            stitch(filename, chunk_jobs)
+        except (IOError, OSError) as e:
+            print 'WARNING:  Could not stitch %s: %s' % (filename, e)
+    print 'JOB COMPLETE!'
 
-print 'Waiting for completion signal from local nodes...'
-while not transcode_complete(local_nova, local_servers, 'local'):
-    sleep(5)
-print 'Received completion signal from local nodes'
 
-print 'Retrieving data...'
-retrieve(local_swift)
-kill_servers(local_servers)
-print 'JOB COMPLETE!'
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,28 @@ creating, and otherwise managing worker nodes.
 """
 from novaclient import exceptions
 from time import sleep
-from threading import Thread
-from requests import post, get, ConnectionError
+from threading import Thread, Lock, Event
+from multiprocessing.pool import ThreadPool
+from requests import post, get, ConnectionError, Timeout
 import json
+from catalog import list_flavors, list_images, best_flavor, \
+    DEFAULT_CATALOG_TTL
+
+# Cache of worker REST API base URLs, keyed by server id. See worker_endpoint
+endpoints = dict()
+endpoints_lock = Lock()
+
+# Seconds between polls of a booting fleet, and the most that interval backs
+# off to when nova rate limits us. See BootMonitor
+BOOT_POLL_INTERVAL = 2
+MAX_BOOT_POLL_INTERVAL = 60
+
+# Seconds to wait for a /boot probe, and the most probes made at once
+BOOT_PROBE_TIMEOUT = 5
+BOOT_PROBE_THREADS = 16
+
+# Seconds a spawn thread waits for its server to boot before giving up on it
+BOOT_TIMEOUT = 1800
 
 
 def load_credentials(filename):
@@ -48,56 +67,135 @@ def hack_url(url):
     return scheme + '://172.29.74.183:' + newport + '/' + path
 
 
-def post_workload(nova_client, server, workload, loc):
-    """ Using the REST API on each of the worker nodes, this is function uses
-    HTTP POST to send a workload to each image after all the workloads have
-    been partitioned.
+def worker_endpoint(nova_client, server, loc):
+    """ Returns the base URL of the REST API of a worker node, which listens
+    on port 5000. A server keeps its address for as long as it exists, so the
+    address is only looked up from nova the first time, and is reused by
+    every later REST call until forget_endpoint is called for the server
+    (when it is deleted or rebuilt)
     """
+    with endpoints_lock:
+        endpoint = endpoints.get(server.id)
+    if endpoint:
+        return endpoint
 
-    # Retrieve IP address of the server for the post request
-    addr_keys = nova_client.servers.ips(server).keys()[0]
-    ip_address = nova_client.servers.ips(server)[addr_keys][0]['addr']\
-        .encode('ascii')
-
-    # REST API is listening on port 5000, and the POST URL is /jobs
-    url = "http://" + ip_address + ':5000/jobs'
+    addresses = nova_client.servers.ips(server)
+    ip_address = addresses[addresses.keys()[0]][0]['addr'].encode('ascii')
+    endpoint = 'http://' + ip_address + ':5000'
 
     # Voodoo bit of coding to make it work on local and non-local clouds
     # using the hack_url function
     if loc == 'local':
-        url = hack_url(url)
+        endpoint = hack_url(endpoint + '/').rstrip('/')
+
+    with endpoints_lock:
+        endpoints[server.id] = endpoint
+    return endpoint
+
+
+def forget_endpoint(server):
+    """ Drops the cached address of a server. Must be called whenever a
+    server is deleted or rebuilt, as its address may change
+    """
+    with endpoints_lock:
+        endpoints.pop(server.id, None)
+
+
+def worker_url(nova_client, server, loc, path):
+    """ Builds the URL of a path on the REST API of a worker node """
+    return worker_endpoint(nova_client, server, loc) + path
+
+
+def post_pull(nova_client, server, loc, dispatcher_url, notify_url=None):
+    """ Instead of sending a workload, tells a worker node to pull its jobs
+    one at a time from the dispatcher running on the manager (see
+    dispatch.py), from the queue of the cloud the worker is on. If a
+    notify_url is given, the worker POSTs completion events to it
+    """
+    url = worker_url(nova_client, server, loc, '/jobs/pull')
+    post(url, data={'dispatcher': dispatcher_url, 'queue': loc,
+                    'worker': server.id, 'notify': notify_url or ''})
+
+
+def post_workload(nova_client, server, workload, loc, notify_url=None):
+    """ Using the REST API on each of the worker nodes, this is function uses
+    HTTP POST to send a workload to each image after all the workloads have
+    been partitioned. If a notify_url is given, the worker POSTs completion
+    events to it
+    """
+
+    # REST API is listening on port 5000, and the POST URL is /jobs
+    url = worker_url(nova_client, server, loc, '/jobs')
 
     # POST request takes a dictionary as argument, {filename: file pointer}
     files_to_upload = {'file': open(workload, 'rb')}
-    post(url, files=files_to_upload)
+    post(url, files=files_to_upload,
+         data={'worker': server.id, 'notify': notify_url or ''})
 
 
-def find_flavor(nova_client, RAM=4096, vCPUs=2):
-    """ Search for a flavor that has exactly 4GB of RAM and 2 vCPUs.
-    If such a flavor is not found, begin a recursive search for the closest
-    matching flavor
+def find_flavor(nova_client, loc='local', credentials=None):
+    """ Find the flavor that gives the most transcoding for the money, using
+    the cached catalog of the cloud's flavors (see catalog.py). The flavor
+    prices are taken from FLAVOR_PRICES in the credentials, if given
     """
-
-    # Upper bound of recursive search
-    if RAM > 262144 or vCPUs > 64:
+    credentials = credentials or dict()
+    flavors = list_flavors(nova_client, loc,
+                           credentials.get('CATALOG_TTL', DEFAULT_CATALOG_TTL))
+    flavor = best_flavor(flavors, credentials.get('FLAVOR_PRICES'))
+    if flavor is None:
         return None
 
-    # Search for the flavor
-    for flavor in nova_client.flavors.list():
-        if flavor.ram == RAM:
-            if flavor.vcpus == vCPUs:
-                print "Flavor found!  Specs: RAM=%d vCPUs=%d" % (RAM, vCPUs)
-                return flavor.id.encode("ascii")
+    print "Flavor found!  %s: RAM=%d vCPUs=%d" % (flavor['name'],
+                                                  flavor['ram'],
+                                                  flavor['vcpus'])
+    return flavor['id'].encode("ascii")
+
+
+def assign_work(nova_client, server, loc, schedule, num, dispatcher_url=None,
+                notify_url=None):
+    """ Gives a booted (or reused) worker node its work. If a dispatcher_url
+    is given, the VM pulls its jobs from the dispatcher, otherwise it is sent
+    the next workload from the schedule. If a notify_url is given, the VM
+    sends completion events to it
+    """
+    if dispatcher_url:
+        # In pull mode, the VM is just told where to get its jobs from
+        print "VM #", num, "pulling jobs from", dispatcher_url
+        post_pull(nova_client, server, loc, dispatcher_url, notify_url)
+
+        # Its workload only decided how many VMs the cloud gets, but it is
+        # still taken off the schedule, as the VM no longer needs spawning
+        schedule.pop(0)
+
+    else:
+        # The schedule variable stores a list of list of videos. Each
+        # internal list is a different workload for each VM. Each time we
+        # go through this loop for each VM, the workload will be different.
+        workload = schedule.pop(0)
+        print "Workload for VM #", num, ":", workload,
+
+        # Write the workload to the necessary file to be POST'd to the
+        # REST API. Every VM gets its own file, as they are all being
+        # given work at the same time
+        workload_file = "workload-%s.txt" % server.id
+        f = open(workload_file, 'w')
+        for video in workload:
+            f.write(video + '\n')
+
+        f.close()
 
-    # If not found, look for something bigger in RAM or vCPUs
-    return (find_flavor(nova_client, RAM * 2, vCPUs) or
-            find_flavor(nova_client, RAM, vCPUs * 2))
+        # Using the REST API, send the workload to the VM
+        post_workload(nova_client, server, workload_file, loc,
+                      notify_url)
 
 
 def spawn_thread(nova_client, image_id, loc, schedule, flavor, num,
-                 server_list):
+                 server_list, monitor, server_name='TransBurst',
+                 dispatcher_url=None, notify_url=None):
     """ Function that gets called when we use threading to simultaneously
-    spawn all required VMs
+    spawn all required VMs. The monitor is the BootMonitor shared by all of
+    the VMs being spawned. See assign_work for dispatcher_url and
+    notify_url
     """
 
     # The try block will attempt to boot the server. There are a number of
@@ -105,33 +203,21 @@ def spawn_thread(nova_client, image_id, loc, schedule, flavor, num,
     # multiple except blocks below.
     try:
         # Attempt to boot server
-        server = activate_image(nova_client, image_id, flavor)
+        server = activate_image(nova_client, image_id, flavor, server_name)
 
-        # Keep checking to make sure the server has been booted.
+        # Wait for the boot monitor to see the server finish booting.
         # If an error state is reached, fall back.
-        while not done_booting(nova_client, server, loc):
-            server = update_status(nova_client, server)
-            if server.status == "ERROR":
-                server.delete()
-                return server_list
-            sleep(2)
-
-        # The schedule variable stores a list of list of videos. Each internal
-        # list is a different workload for each VM. Each time we go through
-        # this loop for each VM, the workload will be different.
-        workload = schedule.pop(0)
-        print "Workload for VM #", num, ":", workload,
-
-        # Write the workload to the necessary file to be POST'd to the REST
-        # API
-        f = open("workload.txt", 'w')
-        for video in workload:
-            f.write(video + '\n')
-
-        f.close()
-
-        # Using the REST API, send the workload to the VM
-        post_workload(nova_client, server, "workload.txt", loc)
+        server = monitor.wait(server)
+        if server.status == "ERROR":
+            forget_endpoint(server)
+            server.delete()
+            return server_list
+        if server.status == "DELETED":
+            forget_endpoint(server)
+            return server_list
+
+        assign_work(nova_client, server, loc, schedule, num, dispatcher_url,
+                    notify_url)
 
     # Various exception blocks to handle problems booting VMs. Print
     # statements cover pretty well what each exception block handles
@@ -155,21 +241,26 @@ def spawn_thread(nova_client, image_id, loc, schedule, flavor, num,
 
 
 def spawn(nova_client, flavor_id, image_id, location, schedule,
-          server_name='TransBurst'):
+          server_name='TransBurst', dispatcher_url=None, notify_url=None):
     """ Spawns a number of VMs given by max_num_instances, which is based
     on the scheduling algorithm. Uses threading so that each VM can be
-    spawned simultaneously
+    spawned simultaneously. See spawn_thread for dispatcher_url and
+    notify_url. Every VM that boots takes its workload off the schedule, so
+    the workloads left in it afterwards are the ones no VM could be spawned
+    for
     """
     server_list = []
     max_num_instances = len(schedule)
     thread_list = []
+    monitor = BootMonitor(nova_client, location, server_name)
 
     # max_num_instances places an upper bound on how many we might need based
     # off the scheduling algorithm
     for i in range(0, max_num_instances):
         print "Spawning %s TransBurst server #%d..." % (location, i)
-        arg_list = (nova_client, image_id, server_name, location, schedule,
-                    flavor_id, i, server_list)
+        arg_list = (nova_client, image_id, location, schedule, flavor_id, i,
+                    server_list, monitor, server_name, dispatcher_url,
+                    notify_url)
         server_init_thread = Thread(target=spawn_thread,
                                     args=arg_list)
         thread_list.append(server_init_thread)
@@ -202,62 +293,197 @@ def done_booting(nova_client, server, loc):
         # Generate the URL to ping based off the IP address from the
         # nova_client. The REST API is listening on port 5000 and the URL
         # we're looking for on the REST API is /boot
-        addr_keys = nova_client.servers.ips(server).keys()[0]
-        ip_address = nova_client.servers.ips(server)[addr_keys][0]['addr']\
-            .encode('ascii')
-        url = 'http://' + ip_address + ':5000/boot'
-
-        # Voodoo magic for demo. Can probably remove these if your clouds
-        # work fine.
-        if loc == 'local':
-            url = hack_url(url)
+        url = worker_url(nova_client, server, loc, '/boot')
 
         # Try/Except block for checking if the REST API is up and listening
         try:
-            get(url)
-            print ip_address + ' is done booting. REST API listening.'
+            get(url, timeout=BOOT_PROBE_TIMEOUT)
+            print url + ' is done booting. REST API listening.'
             return True
-        except ConnectionError:
+        except (ConnectionError, Timeout):
             # If a ConnectionError is thrown, the except block simply passes,
             # as the next line will return false anyway
             pass
     return False
 
 
+class BootMonitor(object):
+    """ Watches a fleet of booting servers. Rather than every spawn thread
+    asking nova about its own server every couple of seconds, one thread
+    lists all the servers with the fleet's name once per interval, backing
+    off if nova rate limits it, and wakes up each waiting spawn thread when
+    its server is ready. The /boot probe (see done_booting) is only made once
+    nova reports a server as ACTIVE.
+    """
+
+    def __init__(self, nova_client, loc, server_name='TransBurst'):
+        self.nova_client = nova_client
+        self.loc = loc
+        self.server_name = server_name
+        self.lock = Lock()
+        self.waiting = dict()
+        self.running = False
+
+    def wait(self, server, timeout=BOOT_TIMEOUT):
+        """ Blocks until the server is either ACTIVE with its REST API
+        listening, in an ERROR state, or gone (in which case its status is
+        set to DELETED). A server that hasn't booted within timeout seconds,
+        or that can't be watched because the monitor failed, is returned
+        with its status set to ERROR. Returns the up to date server
+        """
+        entry = {'server': server, 'ready': Event()}
+        with self.lock:
+            self.waiting[server.id] = entry
+            if not self.running:
+                self.running = True
+                Thread(target=self.run).start()
+
+        if not entry['ready'].wait(timeout):
+            with self.lock:
+                timed_out = self.waiting.pop(server.id, None) is not None
+            if timed_out:
+                print 'Server %s did not boot within %d seconds' % \
+                    (server.id, timeout)
+                entry['server'].status = 'ERROR'
+        return entry['server']
+
+    def run(self):
+        """ The monitor thread. Exits once nobody is waiting any more. If it
+        fails, every waiting spawn thread is woken up with an ERROR status
+        rather than being left waiting on a monitor that is gone
+        """
+        try:
+            self.poll()
+        except Exception as e:
+            print 'Boot monitor for %s failed: %s' % (self.loc, e)
+            self.fail_all()
+
+    def poll(self):
+        """ Polls the fleet every interval until nobody is waiting. Errors
+        from nova or the /boot probes are logged and the polling backs off,
+        the same as when nova rate limits us
+        """
+        interval = BOOT_POLL_INTERVAL
+        probe_pool = ThreadPool(BOOT_PROBE_THREADS)
+        while True:
+            with self.lock:
+                if not self.waiting:
+                    self.running = False
+                    probe_pool.close()
+                    return
+                waiting = dict(self.waiting)
+
+            try:
+                self.check(waiting, probe_pool)
+                interval = BOOT_POLL_INTERVAL
+            except exceptions.RateLimit:
+                interval = min(interval * 2, MAX_BOOT_POLL_INTERVAL)
+                print 'Rate limit reached. Polling again in %d seconds...' % \
+                    interval
+            except Exception as e:
+                interval = min(interval * 2, MAX_BOOT_POLL_INTERVAL)
+                print 'Error polling %s servers (%s). Polling again in %d ' \
+                    'seconds...' % (self.loc, e, interval)
+
+            sleep(interval)
+
+    def check(self, waiting, probe_pool):
+        """ Lists the fleet once, and wakes up the threads waiting on every
+        server that is done booting, in an ERROR state or gone
+        """
+        listed = self.nova_client.servers.list(
+            detail=True, search_opts={'name': self.server_name})
+
+        # Updates every waiting server, and probes the ones that are
+        # ACTIVE all at once. A server missing from the list has been
+        # deleted by someone else, so there's nothing left to wait for
+        active = []
+        listed = dict((server.id, server) for server in listed)
+        for server_id, entry in waiting.iteritems():
+            server = listed.get(server_id)
+            if server is None:
+                entry['server'].status = 'DELETED'
+                self.release(server_id)
+                continue
+
+            entry['server'] = server
+            if server.status == 'ERROR':
+                self.release(server_id)
+            elif server.status == 'ACTIVE':
+                active.append(server)
+
+        booted = probe_pool.map(
+            lambda server: done_booting(self.nova_client, server, self.loc),
+            active)
+        for server, done in zip(active, booted):
+            if done:
+                self.release(server.id)
+
+    def release(self, server_id):
+        """ Wakes up the thread waiting on a server, if it is still waiting
+        """
+        with self.lock:
+            entry = self.waiting.pop(server_id, None)
+        if entry:
+            entry['ready'].set()
+
+    def fail_all(self):
+        """ Wakes up every waiting thread with its server in an ERROR state,
+        and lets the next wait start a new monitor
+        """
+        with self.lock:
+            entries = self.waiting.values()
+            self.waiting.clear()
+            self.running = False
+        for entry in entries:
+            entry['server'].status = 'ERROR'
+            entry['ready'].set()
+
+
 def kill_servers(server_list):
     """ Kills a list of servers """
     for index, server in enumerate(server_list):
         print "Destroying server " + str(index + 1)
+        forget_endpoint(server)
         server.delete()
 
 
-def find_image(glance_client, image_name='worker'):
+def find_image(glance_client, image_name='worker', loc='local'):
     """ Find and return an image ID for the image we want, since this is how
     OpenStack actually allows us to start up images of a specified type. For
     this project, the image we have is always called 'worker', so this id the
-    default, but it can be easily changed.
+    default, but it can be easily changed. The images are listed from the
+    cached catalog of the cloud (see catalog.py)
     """
-    image_list = list(glance_client.images.list())
-    for image in image_list:
-        if image.name == image_name:
-            return image.id
+    for image in list_images(glance_client, loc):
+        if image['name'] == image_name:
+            return image['id']
     return None
 
 
-def find_local_max(nova_client, tenant_name, flavor):
-    """ Given the resources you have available and the resources a single VM
-    consumes, calculate how many VMs you can fit on your cloud. To do this we
-    use the quotas API, and while this isn't perfect, it gets the job done
-    satisfactorily in this case
+def find_local_max(nova_client, flavor):
+    """ Given the resources still free on your cloud and the resources a
+    single VM consumes, calculate how many more VMs you can fit on it. The
+    limits API gives the quota of the tenant we are authenticated as along
+    with how much of it is already in use, so servers that are already
+    running are taken into account. Returns None if the quota is unlimited
     """
     flavor = nova_client.flavors.get(flavor)
-    ram_per_vm = flavor.ram
-    cores_per_vm = flavor.vpus
-
-    quota = nova_client.quotas.get(tenant_name)
-    max_ram = quota.ram
-    max_cores = quota.cores
-    max_servers = quota.server_groups
-
-    num_vms = min(max_ram / ram_per_vm, max_cores / cores_per_vm, max_servers)
-    return num_vms
+    absolute = dict((limit.name, limit.value)
+                    for limit in nova_client.limits.get().absolute)
+
+    # (quota, usage, amount a single VM uses) for every limited resource
+    resources = [('maxTotalInstances', 'totalInstancesUsed', 1),
+                 ('maxTotalCores', 'totalCoresUsed', flavor.vcpus),
+                 ('maxTotalRAMSize', 'totalRAMUsed', flavor.ram)]
+    limits = []
+    for quota, usage, per_vm in resources:
+        # A negative quota means that resource is unlimited
+        if absolute.get(quota, -1) < 0:
+            continue
+        free = absolute[quota] - absolute.get(usage, 0)
+        limits.append(max(free, 0) / per_vm)
+
+    if not limits:
+        return None
+    return min(limits)
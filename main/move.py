@@ -1,53 +1,488 @@
 """ COPYRIGHT Cisco Systems, Inc. 2015
 Small collection of functions about moving data to and from swift
+
+Run on its own, it uploads files to the 'videos' container of either cloud,
+for example to stage videos on the remote cloud ahead of time:
+'./move.py remote file1 file2 ...'
 """
-from threading import Thread
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+from swiftclient import Connection, ClientException
+import resource
+import hashlib
+import json
+import time
+import sys
+import os
+from clients import create_swift_client, SwiftPool
+
+# Downloads are streamed to disk in chunks of this many bytes, so only one
+# chunk per stream is ever held in memory
+CHUNK_SIZE = 1024 * 1024
+
+# Objects smaller than this are never split into range requests
+RANGE_THRESHOLD = 256 * 1024 * 1024
+
+# Files bigger than this are uploaded in segments of this size as a Static
+# Large Object, since swift won't take single objects over 5GB
+SEGMENT_SIZE = 1024 * 1024 * 1024
+
+# Number of segments uploaded at once, and how many times a failed segment
+# is retried before giving up on the upload
+UPLOAD_THREADS = 4
+SEGMENT_RETRIES = 3
+
+# Number of files retrieved at once, and how many times a failed download is
+# retried before moving on
+RETRIEVE_THREADS = 8
+RETRIEVE_RETRIES = 3
+
+# Number of files move uploads at once, and how many times a failed file is
+# retried before giving up on it
+MOVE_THREADS = 4
+MOVE_RETRIES = 3
+
+
+def with_retries(action, description, retries,
+                 errors=(ClientException, IOError)):
+    """ Calls action(), retrying with exponential backoff whenever it raises
+    one of errors, and re-raising once it has failed retries more times.
+    Returns what action returns
+    """
+    for attempt in range(retries + 1):
+        try:
+            return action()
+        except errors as e:
+            if attempt == retries:
+                raise
+            print 'Retrying %s after error: %s' % (description, e)
+            time.sleep(2 ** attempt)
 
 
-def move_thread(swift_client, clip, container):
-    """ Thread that gets called so swift moves can be done in parallel """
-    print 'Uploading %s' % clip
-    with open(clip, 'rb') as f:
-        swift_client.put_object(container, clip, contents=f,
-                                content_type="video")
-    print 'Done uploading %s' % clip
+def move_file(swift_client, clip, container, retries=MOVE_RETRIES):
+    """ Uploads a single file for move, retrying with backoff if it fails.
+    Returns the number of bytes uploaded
+    """
+    def upload_clip():
+        upload(swift_client, container, clip, name=clip)
+        return os.path.getsize(clip)
+    return with_retries(upload_clip, clip, retries)
 
 
-def move(swift_client, file_list, container="videos"):
-    """ Moves a list of files in 'parallel' using threads into a swift
-    container
+def move(swift_client, file_list, container="videos",
+         num_threads=MOVE_THREADS, retries=MOVE_RETRIES):
+    """ Moves a list of files in parallel into a swift container, at most
+    num_threads at a time. Every thread uploads on its own connection, since
+    swift connections are not thread safe, and a file that fails is retried
+    before being given up on. Prints progress as files finish and the
+    overall upload speed at the end, and returns the files that could not be
+    uploaded
     """
     swift_client.put_container(container)
-    print '\"Videos\" container created'
-    threads = []
-    # Loops through all the video clips in the file_list to upload them to swift
-    for clip in file_list:
-        arg_list = (swift_client, clip, container)
+    print '"%s" container created' % container
+
+    swift_pool = SwiftPool(lambda: clone_client(swift_client), num_threads)
+    progress = {'done': 0, 'bytes': 0}
+    progress_lock = Lock()
+    start_time = time.time()
+
+    def move_one(clip):
+        try:
+            with swift_pool.connection() as swift:
+                size = move_file(swift, clip, container, retries)
+        except (ClientException, IOError, OSError) as e:
+            print 'Could not upload %s: %s' % (clip, e)
+            return False
+
+        with progress_lock:
+            progress['done'] += 1
+            progress['bytes'] += size
+            elapsed = max(time.time() - start_time, 1e-6)
+            print '[%d/%d] Uploaded %s, %.1f MB/s so far' % \
+                (progress['done'], len(file_list), clip,
+                 progress['bytes'] / (1024.0 * 1024.0) / elapsed)
+        return True
+
+    pool = ThreadPool(max(1, min(num_threads, len(file_list))))
+    results = pool.map(move_one, file_list)
+    pool.close()
+    pool.join()
 
-        # Here we keep a list of the threads moving stuff to swift
-        threads.append(Thread(target=move_thread, args=arg_list).start())
-        threads[-1].start()
+    failed = [clip for clip, moved in zip(file_list, results) if not moved]
+    elapsed = max(time.time() - start_time, 1e-6)
+    print 'Uploaded %d of %d files (%.1f MB) to "%s" at %.1f MB/s' % \
+        (progress['done'], len(file_list),
+         progress['bytes'] / (1024.0 * 1024.0), container,
+         progress['bytes'] / (1024.0 * 1024.0) / elapsed)
+    if failed:
+        print 'WARNING:  %d files failed to upload' % len(failed)
+    return failed
+
+
+def local_md5(filename, chunk_size=CHUNK_SIZE):
+    """ MD5 of a local file, read chunk_size bytes at a time """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def retrieve_object(swift_pool, container, name, directory='.', etag=None,
+                    retries=RETRIEVE_RETRIES):
+    """ Downloads one object into directory on a connection from swift_pool
+    (see clients.py), retrying with backoff if it fails. If a local copy
+    whose MD5 matches etag is already there, nothing is downloaded (the etag
+    of a segmented object is not the MD5 of its contents, so those are always
+    downloaded again). The object is downloaded to a '.part' file that is
+    only renamed once it is complete, so an interrupted retrieve never leaves
+    a truncated file behind. Returns the number of bytes downloaded
+    """
+    filename = os.path.join(directory, name)
+    if etag and os.path.isfile(filename) and local_md5(filename) == etag:
+        print 'Skipping %s, already downloaded' % name
+        return 0
 
-    # This ensures that the move function will not exit until all threads are
-    # finished
-    for thread in threads:
-        thread.join()
+    # Objects named like 'video/segment.ts' go into their own directory
+    if os.path.dirname(name):
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError:
+            pass
 
-    print 'Done uploading to LOCAL cloud...'
+    def download_object():
+        with swift_pool.connection() as swift:
+            download(swift, container, name, filename + '.part')
+        os.rename(filename + '.part', filename)
+        return os.path.getsize(filename)
+    return with_retries(download_object, name, retries,
+                        (ClientException, IOError, OSError))
 
 
-def retrieve(swift_client):
+def retrieve(swift_client, container='completed', directory='.',
+             num_threads=RETRIEVE_THREADS):
     """ Grabs all of the files from the 'completed' folder in the the local
-    swift, which is where they are always put at the end of a transcode
-    """
-    container_data = []
-    # Goes through to get all of the files in the container
-    for data in swift_client.get_container('completed')[1]:
-        container_data.append('{0}'.format(data['name']))
-
-    # Goes through to download all of the files found in the container
-    for f in container_data:
-        print 'Downloading %s to local drive...' % f
-        obj_tuple = swift_client.get_object('completed', f)
-        with open(f, 'wb') as xcode_bytes:
-            xcode_bytes.write(obj_tuple[1])
+    swift, which is where they are always put at the end of a transcode.
+    Files are downloaded num_threads at a time, and files that are already
+    there from an earlier (or interrupted) retrieve are skipped, so running
+    it again only fetches what is missing. Prints the overall download speed
+    and returns the names of any files that could not be downloaded
+    """
+    # full_listing pages through the whole container, rather than stopping
+    # at the first 10000 objects
+    objects = swift_client.get_container(container, full_listing=True)[1]
+    start_time = time.time()
+    swift_pool = SwiftPool(lambda: clone_client(swift_client), num_threads)
+
+    def retrieve_one(obj):
+        try:
+            return retrieve_object(swift_pool, container, obj['name'],
+                                   directory, obj['hash'])
+        except (ClientException, IOError, OSError) as e:
+            print 'Could not download %s: %s' % (obj['name'], e)
+            return None
+
+    pool = ThreadPool(max(1, min(num_threads, len(objects))))
+    sizes = pool.map(retrieve_one, objects)
+    pool.close()
+    pool.join()
+
+    failed = [obj['name'] for obj, size in zip(objects, sizes)
+              if size is None]
+    total = sum(size for size in sizes if size)
+    elapsed = max(time.time() - start_time, 1e-6)
+    print 'Retrieved %d of %d files (%.1f MB) at %.1f MB/s' % \
+        (len(objects) - len(failed), len(objects), total / (1024.0 * 1024.0),
+         total / (1024.0 * 1024.0) / elapsed)
+    if failed:
+        print 'WARNING:  %d files failed to download, run retrieve again ' \
+            'to resume' % len(failed)
+    return failed
+
+
+def retrieve_as_completed(swift_client, tracker, container='completed',
+                          directory='.', num_threads=RETRIEVE_THREADS):
+    """ Starts downloading each transcoded file as soon as its worker reports
+    placing it in swift, using the job events collected by a
+    CompletionTracker (see dispatch.py). If an event has a prefix, as it
+    does for output uploaded one HLS segment at a time, every object under
+    that prefix is downloaded. Returns a CompletedRetriever, which should be
+    closed and joined before a final retrieve picks up anything that was
+    missed
+    """
+    retriever = CompletedRetriever(tracker, num_threads)
+    swift_pool = SwiftPool(lambda: clone_client(swift_client), num_threads)
+
+    def retrieve_one(name, prefix=None):
+        try:
+            names = [name]
+            if prefix:
+                with swift_pool.connection() as swift:
+                    names = [obj['name'] for obj in swift.get_container(
+                        container, prefix=prefix, full_listing=True)[1]]
+            for name in names:
+                retrieve_object(swift_pool, container, name, directory)
+        except (ClientException, IOError, OSError) as e:
+            print 'Could not download %s: %s' % (name, e)
+
+    def on_job(event):
+        if event.get('output'):
+            retriever.submit(retrieve_one, (event['output'],
+                                            event.get('prefix')))
+
+    retriever.callback = on_job
+    tracker.job_callbacks.append(on_job)
+    return retriever
+
+
+class CompletedRetriever(object):
+    """ The downloads started by retrieve_as_completed. Once it is closed,
+    job events that come in late are ignored rather than handed to a closed
+    pool, which would raise in the dispatcher's request handler
+    """
+
+    def __init__(self, tracker, num_threads=RETRIEVE_THREADS):
+        self.tracker = tracker
+        self.pool = ThreadPool(num_threads)
+        self.lock = Lock()
+        self.closed = False
+        self.callback = None
+
+    def submit(self, func, args):
+        """ Starts func(*args) in the pool, unless it has been closed """
+        with self.lock:
+            if not self.closed:
+                self.pool.apply_async(func, args)
+
+    def close(self):
+        """ Stops taking job events, and lets the pool finish """
+        with self.lock:
+            self.closed = True
+            if self.callback in self.tracker.job_callbacks:
+                self.tracker.job_callbacks.remove(self.callback)
+            self.pool.close()
+
+    def join(self):
+        """ Waits for the downloads already started to finish """
+        self.pool.join()
+
+
+def peak_memory():
+    """ Returns the peak resident memory of this process so far in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def clone_client(swift_client):
+    """ Swift connections are not thread safe, so every thread needs its own.
+    This creates a new connection that reuses the storage URL and token of an
+    existing one rather than authenticating again. It also gets the
+    credentials of the existing one, so it can authenticate again once the
+    token expires
+    """
+    if not swift_client.url or not swift_client.token:
+        swift_client.get_auth()
+    return Connection(authurl=swift_client.authurl,
+                      user=swift_client.user,
+                      key=swift_client.key,
+                      auth_version=swift_client.auth_version,
+                      os_options=dict(swift_client.os_options or {}),
+                      preauthurl=swift_client.url,
+                      preauthtoken=swift_client.token)
+
+
+def download_range(swift_client, container, name, filename, start, end,
+                   chunk_size=CHUNK_SIZE):
+    """ Downloads bytes start through end (inclusive) of an object into the
+    same place in an already allocated local file
+    """
+    headers, body = clone_client(swift_client).get_object(
+        container, name, resp_chunk_size=chunk_size,
+        headers={'Range': 'bytes=%d-%d' % (start, end)})
+    with open(filename, 'r+b') as f:
+        f.seek(start)
+        for chunk in body:
+            f.write(chunk)
+
+
+def download(swift_client, container, name, filename=None,
+             chunk_size=CHUNK_SIZE, num_ranges=1,
+             range_threshold=RANGE_THRESHOLD):
+    """ Downloads an object from swift straight to disk, chunk_size bytes at
+    a time, so the object never has to fit in memory. If num_ranges is more
+    than 1 and the object is bigger than range_threshold, it is instead split
+    into num_ranges HTTP range requests which are downloaded in parallel.
+    Prints and returns the download speed in MB/s.
+    """
+    if filename is None:
+        filename = name
+    start_time = time.time()
+
+    size = None
+    if num_ranges > 1:
+        size = int(swift_client.head_object(container, name)['content-length'])
+
+    if size is not None and size > range_threshold:
+        # Allocates the whole file up front so each range can be written in
+        # place as it arrives
+        with open(filename, 'wb') as f:
+            f.truncate(size)
+        range_size = -(-size // num_ranges)
+        ranges = [(start, min(start + range_size, size) - 1)
+                  for start in range(0, size, range_size)]
+
+        pool = ThreadPool(len(ranges))
+        pool.map(lambda (start, end): download_range(
+            swift_client, container, name, filename, start, end, chunk_size),
+            ranges)
+        pool.close()
+        pool.join()
+    else:
+        headers, body = swift_client.get_object(container, name,
+                                                resp_chunk_size=chunk_size)
+        with open(filename, 'wb') as f:
+            for chunk in body:
+                f.write(chunk)
+        size = os.path.getsize(filename)
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    rate = size / (1024.0 * 1024.0) / elapsed
+    print 'Downloaded %s (%.1f MB) at %.1f MB/s, peak memory %.1f MB' % \
+        (name, size / (1024.0 * 1024.0), rate, peak_memory())
+    return rate
+
+
+def upload_segment(swift_pool, container, name, filename, offset, length,
+                   retries=SEGMENT_RETRIES):
+    """ Uploads length bytes of a file starting at offset as its own object,
+    on a connection from swift_pool (see clients.py), retrying with backoff
+    if it fails. Returns the etag of the uploaded segment
+    """
+    def upload_range():
+        with open(filename, 'rb') as f, swift_pool.connection() as swift:
+            f.seek(offset)
+            return swift.put_object(container, name, contents=f,
+                                    content_length=length)
+    return with_retries(upload_range, 'segment ' + name, retries)
+
+
+def upload(swift_client, container, filename, name=None,
+           content_type='video', segment_size=SEGMENT_SIZE,
+           num_threads=UPLOAD_THREADS, retries=SEGMENT_RETRIES):
+    """ Uploads a file to swift, naming it after the file unless a name is
+    given. Files bigger than segment_size are split into segments that are
+    uploaded in parallel to the '<container>_segments' container, and are
+    tied together by a Static Large Object manifest under the given name.
+    Only segments that fail are retried.
+    """
+    if name is None:
+        name = os.path.basename(filename)
+    size = os.path.getsize(filename)
+
+    if size <= segment_size:
+        with open(filename, 'rb') as f:
+            swift_client.put_object(container, name, contents=f,
+                                    content_type=content_type)
+        return
+
+    segment_container = container + '_segments'
+    swift_client.put_container(segment_container)
+
+    # The prefix changes whenever the file does, so segments of an older
+    # upload of the same name are never mixed into the new manifest
+    prefix = '%s/slo/%f/%d/%d/' % (name, os.path.getmtime(filename), size,
+                                   segment_size)
+    segments = [(prefix + '%08d' % i, offset, min(segment_size, size - offset))
+                for i, offset in enumerate(range(0, size, segment_size))]
+    print 'Uploading %s as %d segments' % (name, len(segments))
+
+    pool = ThreadPool(min(num_threads, len(segments)))
+    swift_pool = SwiftPool(lambda: clone_client(swift_client), num_threads)
+    etags = pool.map(lambda (segment, offset, length): upload_segment(
+        swift_pool, segment_container, segment, filename, offset, length,
+        retries), segments)
+    pool.close()
+    pool.join()
+
+    manifest = [{'path': '/%s/%s' % (segment_container, segment),
+                 'etag': etag,
+                 'size_bytes': length}
+                for (segment, offset, length), etag in zip(segments, etags)]
+    swift_client.put_object(container, name, contents=json.dumps(manifest),
+                            content_type=content_type,
+                            query_string='multipart-manifest=put')
+
+
+class SegmentReader(object):
+    """ File-like view of the next length bytes of a stream, for uploading
+    one segment of it. head holds bytes already read from the stream that
+    come first. count is the number of bytes read through it so far
+    """
+
+    def __init__(self, stream, length, head=''):
+        self.stream = stream
+        self.remaining = length
+        self.head = head
+        self.count = 0
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ''
+        if self.head:
+            data, self.head = self.head[:size], self.head[size:]
+        else:
+            data = self.stream.read(size)
+        self.remaining -= len(data)
+        self.count += len(data)
+        return data
+
+
+def upload_stream(swift_client, container, stream, name,
+                  content_type='video', segment_size=SEGMENT_SIZE):
+    """ Uploads everything read from a stream, such as a pipe, whose size
+    isn't known up front. The stream is cut into segments of segment_size,
+    each uploaded to the '<container>_segments' container as soon as it is
+    read, and they are tied together by a Static Large Object manifest under
+    the given name, so the object can be bigger than swift takes in a single
+    upload. Segments can't be retried, as the stream can't be read twice
+    """
+    segment_container = container + '_segments'
+    swift_client.put_container(segment_container)
+
+    prefix = '%s/slo/stream/%f/%d/' % (name, time.time(), segment_size)
+    manifest = []
+    while True:
+        # A segment is only started once there is something to put in it
+        head = stream.read(1)
+        if not head:
+            break
+
+        segment = prefix + '%08d' % len(manifest)
+        reader = SegmentReader(stream, segment_size, head)
+        etag = swift_client.put_object(segment_container, segment,
+                                       contents=reader, chunk_size=CHUNK_SIZE)
+        manifest.append({'path': '/%s/%s' % (segment_container, segment),
+                         'etag': etag,
+                         'size_bytes': reader.count})
+
+    # Swift won't take a manifest without any segments
+    if not manifest:
+        swift_client.put_object(container, name, contents='',
+                                content_type=content_type)
+        return
+
+    print 'Uploaded %s as %d segments' % (name, len(manifest))
+    swift_client.put_object(container, name, contents=json.dumps(manifest),
+                            content_type=content_type,
+                            query_string='multipart-manifest=put')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('local', 'remote'):
+        print 'Usage: ./move.py local|remote file1 [file2 ...]'
+        sys.exit(1)
+
+    credentials = json.load(open('config/' + sys.argv[1] + '.json'))
+    if move(create_swift_client(credentials), sys.argv[2:]):
+        sys.exit(1)
@@ -0,0 +1,190 @@
+""" COPYRIGHT Cisco Systems, Inc. 2015
+Decides which files are transcoded on the local cloud and which are burst
+to the remote cloud, before any VMs are spawned. The local cloud is treated
+as free but limited by its quota, while the remote cloud is billed by the
+hour for each VM plus a cost for every GB of video sent to it. The optional
+settings below are read from local.json and remote.json:
+
+BOOT_LATENCY            Seconds from spawning a VM until it accepts work
+PRICE_PER_HOUR          Price of one remote VM for an hour (remote only)
+TRANSFER_COST_PER_GB    Price of moving a GB of video to the remote cloud
+BANDWIDTH_MBPS          Download speed of a remote VM from swift in MB/s
+MAX_INSTANCES           Upper bound on the number of remote VMs
+"""
+from math import ceil
+from heapq import heappush, heappop
+from scheduling import schedule_jobs
+
+# Used for any of the settings above that a cloud's credentials leave out
+DEFAULT_BOOT_LATENCY = 120.0
+DEFAULT_PRICE_PER_HOUR = 1.0
+DEFAULT_TRANSFER_COST_PER_GB = 0.0
+DEFAULT_BANDWIDTH_MBPS = 50.0
+
+GB = 1024.0 ** 3
+MB = 1024.0 ** 2
+
+
+def remote_cost(remote_times, transferred_bytes, remote_credentials):
+    """ Cost of running the given remote VMs, each billed for every started
+    hour from boot until its predicted completion, plus the transfer cost of
+    the videos sent to them
+    """
+    price = remote_credentials.get('PRICE_PER_HOUR', DEFAULT_PRICE_PER_HOUR)
+    boot = remote_credentials.get('BOOT_LATENCY', DEFAULT_BOOT_LATENCY)
+    transfer = remote_credentials.get('TRANSFER_COST_PER_GB',
+                                      DEFAULT_TRANSFER_COST_PER_GB)
+    hours = sum(ceil((boot + busy) / 3600.0) for busy in remote_times)
+    return hours * price + transferred_bytes / GB * transfer
+
+
+def pack_onto(jobs, num_vms):
+    """ Spreads a list of (filename, predicted time) pairs over a fixed
+    number of VMs, longest first onto the least loaded VM, for when there
+    aren't enough VMs to finish everything before the deadline. Returns the
+    workloads and predicted completion times, as schedule_jobs does
+    """
+    if num_vms < 1:
+        return [], []
+
+    workloads = [[] for i in range(num_vms)]
+    loads = [0.0] * num_vms
+    heap = [(0.0, i) for i in range(num_vms)]
+    for filename, time_est in sorted(jobs, key=lambda job: job[1],
+                                     reverse=True):
+        load, i = heappop(heap)
+        workloads[i].append(filename)
+        loads[i] += time_est
+        heappush(heap, (loads[i], i))
+
+    used = [i for i in range(num_vms) if workloads[i]]
+    return [workloads[i] for i in used], [loads[i] for i in used]
+
+
+def remote_jobs_for(filenames, predicted, sizes, remote_credentials,
+                    speedup=1.0):
+    """ (filename, predicted time) pairs for running files on remote VMs
+    that transcode speedup times as fast as the predictions assume, where
+    each file also takes the time to download it
+    """
+    bandwidth = remote_credentials.get('BANDWIDTH_MBPS',
+                                       DEFAULT_BANDWIDTH_MBPS)
+    return [(filename, predicted[filename] / speedup +
+             sizes.get(filename, 0) / MB / bandwidth)
+            for filename in filenames]
+
+
+def plan_placement(jobs, sizes, remaining, local_max, local_credentials,
+                   remote_credentials, strategy='ffd', local_speedup=1.0,
+                   remote_speedup=1.0):
+    """ Splits a list of (filename, predicted time) pairs between the local
+    and remote clouds, given the size of each file in bytes, the time until
+    the deadline and the number of VMs the local quota allows (None if
+    unlimited). The predictions are made for the base VM, and are divided by
+    the speedup of the flavor each cloud runs (see catalog.flavor_speedup).
+
+    Files are placed on local VMs first, which cost nothing to use. They are
+    taken in order of how much they would cost to run remotely, most
+    expensive first, and each goes on the first local VM with enough time
+    left before the deadline, so the cheapest files to burst are the ones
+    left over. Those are then packed onto as few remote VMs as possible,
+    where each file also pays for the time it takes to download it.
+
+    Returns a dictionary with the local and remote workloads (one list of
+    filenames per VM), the predicted completion time of each VM, and the
+    predicted remote cost.
+    """
+    local_boot = local_credentials.get('BOOT_LATENCY', DEFAULT_BOOT_LATENCY)
+    remote_boot = remote_credentials.get('BOOT_LATENCY', DEFAULT_BOOT_LATENCY)
+    price = remote_credentials.get('PRICE_PER_HOUR', DEFAULT_PRICE_PER_HOUR)
+    transfer = remote_credentials.get('TRANSFER_COST_PER_GB',
+                                      DEFAULT_TRANSFER_COST_PER_GB)
+    bandwidth = remote_credentials.get('BANDWIDTH_MBPS',
+                                       DEFAULT_BANDWIDTH_MBPS)
+
+    local_capacity = max(remaining - local_boot, 1.0)
+    remote_capacity = max(remaining - remote_boot, 1.0)
+
+    def burst_cost(job):
+        filename, time_est = job
+        return (time_est / remote_speedup +
+                sizes.get(filename, 0) / MB / bandwidth) * \
+            price / 3600.0 + sizes.get(filename, 0) / GB * transfer
+
+    # First fit into a bounded number of local VMs
+    local_bins = []
+    local_loads = []
+    bursted = []
+    for job in sorted(jobs, key=burst_cost, reverse=True):
+        local_time = job[1] / local_speedup
+        for i, load in enumerate(local_loads):
+            if load + local_time <= local_capacity:
+                local_bins[i].append(job[0])
+                local_loads[i] += local_time
+                break
+        else:
+            if local_max is None or len(local_bins) < local_max:
+                if local_time > local_capacity:
+                    print "WARNING:  File is too big to be transcoded by " \
+                        "VM in time."
+                local_bins.append([job[0]])
+                local_loads.append(local_time)
+            else:
+                bursted.append(job)
+
+    # Remote VMs have to download each of their files before transcoding it
+    remote_jobs = remote_jobs_for([filename for filename, t in bursted],
+                                  dict(bursted), sizes, remote_credentials,
+                                  remote_speedup)
+    remote_bins, remote_loads = schedule_jobs(remote_jobs, remote_capacity,
+                                              strategy)
+
+    # Past MAX_INSTANCES, the burst files are spread over as many VMs as are
+    # allowed rather than given the VMs they need
+    max_remote = remote_credentials.get('MAX_INSTANCES')
+    if max_remote is not None and len(remote_bins) > max_remote:
+        print 'WARNING:  Remote cloud needs %d VMs, but only %d are ' \
+            'allowed. The deadline will likely be missed.' % \
+            (len(remote_bins), max_remote)
+        remote_bins, remote_loads = pack_onto(remote_jobs, max(max_remote, 0))
+        if not remote_bins:
+            print 'WARNING:  %d files will not be transcoded.' % len(bursted)
+            bursted = []
+
+    transferred = sum(sizes.get(filename, 0) for filename, t in bursted)
+    cost = remote_cost(remote_loads, transferred, remote_credentials)
+
+    print 'Placement: %d local VMs, %d remote VMs, %d files burst ' \
+        '(%.1f GB), predicted remote cost %.2f' % \
+        (len(local_bins), len(remote_bins), len(bursted), transferred / GB,
+         cost)
+
+    return {'local': local_bins,
+            'remote': remote_bins,
+            'local_times': local_loads,
+            'remote_times': remote_loads,
+            'remote_cost': cost}
+
+
+def plan_burst(workloads, predicted, sizes, remote_vms, remote_credentials,
+               remote_speedup=1.0):
+    """ Plans remote VMs for local workloads that couldn't be given a local
+    VM after all, e.g. because the local cloud refused to spawn more, given
+    the predicted time of every file, the number of remote VMs already
+    planned and the speedup of the remote flavor. Each workload gets a
+    remote VM of its own, unless that would take the remote cloud over
+    MAX_INSTANCES, in which case their files are spread over the VMs that
+    are left. Returns the remote workloads
+    """
+    max_remote = remote_credentials.get('MAX_INSTANCES')
+    if max_remote is None or remote_vms + len(workloads) <= max_remote:
+        return workloads
+
+    available = max(max_remote - remote_vms, 0)
+    print 'WARNING:  %d more remote VMs are needed, but only %d are ' \
+        'allowed. The deadline will likely be missed.' % \
+        (len(workloads), available)
+    filenames = [filename for workload in workloads for filename in workload]
+    return pack_onto(remote_jobs_for(filenames, predicted, sizes,
+                                     remote_credentials, remote_speedup),
+                     available)[0]
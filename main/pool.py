@@ -0,0 +1,130 @@
+""" COPYRIGHT Cisco Systems, Inc. 2015
+Warm pool of worker VMs kept alive between runs of main.py. Booting a fresh
+VM and waiting for its REST API takes minutes, which dominates small jobs.
+Instead of destroying its VMs at the end of a run, the manager can keep up
+to WARM_POOL_SIZE of them idle (set per cloud in local.json and remote.json),
+and the next run resets and reuses them before spawning anything new.
+Servers idle for longer than WARM_POOL_TTL seconds are destroyed the next
+time the pool is touched, or by running './pool.py reap' (e.g. from cron).
+
+The pool is stored in pool.json, in the form: {
+                                               'local': [{'id': server id,
+                                                          'idle_since': time}]
+                                               'remote': [...]
+                                             }
+"""
+from threading import Lock
+from requests import post, RequestException
+from novaclient import exceptions
+import time
+import sys
+from manager import worker_url, forget_endpoint, load_credentials
+from clients import create_nova_client
+from state import load_state, save_state
+
+POOL_FILENAME = 'pool.json'
+
+# Used when local.json or remote.json leave out WARM_POOL_SIZE or
+# WARM_POOL_TTL. A pool size of 0 means no VMs are kept, as before
+DEFAULT_POOL_SIZE = 0
+DEFAULT_POOL_TTL = 1800
+
+# Both clouds may use the pool at the same time
+pool_lock = Lock()
+
+
+def destroy(nova_client, server_id):
+    """ Destroys a server by id, if it still exists """
+    print 'Destroying idle server', server_id
+    try:
+        nova_client.servers.delete(server_id)
+    except exceptions.NotFound:
+        pass
+
+
+def reset_worker(nova_client, server, loc):
+    """ Clears the state a worker has left over from its last workload, using
+    its REST API. Returns whether the worker was reachable and idle
+    """
+    try:
+        response = post(worker_url(nova_client, server, loc, '/reset'),
+                        timeout=5)
+        return response.status_code == 200
+    except RequestException:
+        return False
+
+
+def claim(nova_client, loc, count, pool_filename=POOL_FILENAME):
+    """ Takes up to count idle servers for the given cloud out of the pool,
+    resets them, and returns them ready for new work. Pooled servers that are
+    gone, broken or unreachable are dropped from the pool (and destroyed)
+    """
+    claimed = []
+    with pool_lock:
+        pool = load_state(pool_filename)
+        entries = pool.get(loc, [])
+        while entries and len(claimed) < count:
+            entry = entries.pop(0)
+            try:
+                server = nova_client.servers.get(entry['id'])
+            except exceptions.NotFound:
+                continue
+
+            if server.status == 'ACTIVE' and \
+                    reset_worker(nova_client, server, loc):
+                print 'Reusing warm %s server %s' % (loc, server.id)
+                claimed.append(server)
+            else:
+                forget_endpoint(server)
+                destroy(nova_client, server.id)
+
+        pool[loc] = entries
+        save_state(pool, pool_filename)
+    return claimed
+
+
+def release(nova_client, loc, servers, size, ttl,
+            pool_filename=POOL_FILENAME):
+    """ Returns servers that have finished their work to the pool, keeping at
+    most size servers idle for the given cloud. Servers that don't fit and
+    pooled servers that have been idle for longer than ttl are destroyed
+    """
+    now = time.time()
+    with pool_lock:
+        pool = load_state(pool_filename)
+        entries = []
+        for entry in pool.get(loc, []):
+            if now - entry['idle_since'] < ttl:
+                entries.append(entry)
+            else:
+                destroy(nova_client, entry['id'])
+
+        for server in servers:
+            if len(entries) < size:
+                print 'Keeping %s server %s warm' % (loc, server.id)
+                entries.append({'id': server.id, 'idle_since': now})
+            else:
+                forget_endpoint(server)
+                destroy(nova_client, server.id)
+
+        pool[loc] = entries
+        save_state(pool, pool_filename)
+
+
+def reap(nova_client, loc, ttl, pool_filename=POOL_FILENAME):
+    """ Destroys the pooled servers of a cloud that have been idle for longer
+    than ttl
+    """
+    release(nova_client, loc, [], 0, ttl, pool_filename)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] != 'reap':
+        print 'Usage: ./pool.py reap'
+        sys.exit(1)
+
+    for loc in ('local', 'remote'):
+        credentials = load_credentials('config/' + loc + '.json')
+        if load_state(POOL_FILENAME).get(loc):
+            reap(create_nova_client(credentials), loc,
+                 credentials.get('WARM_POOL_TTL', DEFAULT_POOL_TTL))
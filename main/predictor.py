@@ -10,17 +10,19 @@ Input Video Codec, Input Resolution, Input Audio Codec,
 Input # i-frames, Input # b-frames, Input # p-frames,
 Output Container Format, Output FPS, Output Video Codec,
 Output Resolution, Output Audio Codec, Transcode Time
+
+scikit-learn and the index store are imported only inside the functions that
+need them, so importing this module (which main.py does through
+scheduling.py) stays cheap. Training pulls in the svm, grid_search and
+preprocessing modules, while predicting only needs joblib to load the saved
+models, and only when the prediction cache misses.
 """
-from sklearn.externals import joblib
-from sklearn import preprocessing
-from sklearn import grid_search
-from sklearn import svm
 from math import ceil
+import numpy as np
 import time
 import json
 import csv
 import os
-from ingest import read_index
 
 
 def parse_data(file_name):
@@ -53,6 +55,8 @@ def scale_data((X, T), save=True):
     """ Scale data, save scaler object if requested, and return the
     scaler so future data can be scaled in the same manner
     """
+    from sklearn import preprocessing
+
     scaler = preprocessing.StandardScaler().fit(X)
     X_scaled = scaler.transform(X)
 
@@ -93,6 +97,9 @@ def train_predictor(data, save=True):
     for the support vector regression, then fits the machine to the
     training data, and returns the predictor object
     """
+    from sklearn import grid_search
+    from sklearn import svm
+
     param_grid = [
         {'C': [1, 10, 100, 1000], 'kernel': ['linear']},
         {'C': [1, 10, 100, 1000], 'gamma': [0.0, 1e-3, 1e-4],
@@ -135,6 +142,8 @@ def save_predictor(predictor):
     if not os.path.exists(save_directory):
         os.makedirs(save_directory)
 
+    from sklearn.externals import joblib
+
     joblib.dump(predictor, save_directory + '/predictor.pkl')
 
 
@@ -145,6 +154,8 @@ def load_predictor():
     if not os.path.exists(load_directory):
         raise IOError('No predictor module found')
 
+    from sklearn.externals import joblib
+
     return joblib.load(load_directory + '/predictor.pkl')
 
 
@@ -156,6 +167,8 @@ def save_scaler(scaler):
     if not os.path.exists(save_directory):
         os.makedirs(save_directory)
 
+    from sklearn.externals import joblib
+
     joblib.dump(scaler, save_directory + '/scaler.pkl')
 
 
@@ -166,6 +179,8 @@ def load_scaler():
     if not os.path.exists(load_directory):
         raise IOError('No scaler module found')
 
+    from sklearn.externals import joblib
+
     return joblib.load(load_directory + '/scaler.pkl')
 
 
@@ -178,7 +193,7 @@ def load_config():
     return json.load(open('config/transcode.json'))
 
 
-def generate_vec(filename, transcode_config):
+def generate_vec(filename, transcode_config, index=None):
     """ Generates the vector, using the input and output data on the video,
     used by the machine learning algorithm to predict transcode time. The data
     must be in the same order as when the machine learning algorithm was
@@ -186,8 +201,12 @@ def generate_vec(filename, transcode_config):
 
     [Video Duration, Input FPS, I frames, B frames, P frames, Output FPS,
     Input width, Input height, Output width, Output height]
+
+    The index is read from disk unless an already loaded one is passed in
     """
-    index = read_index()
+    if index is None:
+        from ingest import read_index
+        index = read_index([filename])
     input_info = index[filename]
 
     o_size = transcode_config['video']['size']
@@ -233,6 +252,57 @@ def predict(filename, predictor=None, scaler=None, config=None):
     return time_est
 
 
+def predict_many(filenames, predictor=None, scaler=None, config=None,
+                 index=None, cache=None):
+    """ Batch version of predict. The predictor, scaler, config and index are
+    each loaded at most once, the feature vectors of every file are stacked
+    into a single matrix, and that matrix is scaled and predicted in one call
+    each. Returns a numpy array of estimates in the same order as filenames.
+
+    If a PredictionCache is passed, only the files missing from it are run
+    through the predictor (which is then not even loaded if nothing is
+    missing), and the new predictions are saved back to the cache
+    """
+    if len(filenames) == 0:
+        return np.zeros(0)
+
+    if not config:
+        config = load_config()
+    if index is None:
+        from ingest import read_index
+        index = read_index(filenames)
+
+    time_ests = np.zeros(len(filenames))
+    missing = []
+    for i, filename in enumerate(filenames):
+        cached = cache.get(index[filename]) if cache else None
+        if cached is None:
+            missing.append(i)
+        else:
+            time_ests[i] = cached
+
+    if missing:
+        if not scaler:
+            scaler = load_scaler()
+        if not predictor:
+            predictor = load_predictor()
+
+        X = np.array([generate_vec(filenames[i], config, index)
+                      for i in missing], dtype=float)
+        time_ests[missing] = predictor.predict(scaler.transform(X))
+
+    if cache:
+        for i in missing:
+            cache.put(index[filenames[i]], time_ests[i])
+        cache.save()
+        print cache.stats()
+
+    for filename, time_est in zip(filenames, time_ests):
+        print 'Predicted transcode time for', filename, 'is about', \
+            prettify_time(time_est)
+    return time_ests
+
+
 # Running this file will train a predictor based off the training data found in
 # the specified csv file
 if __name__ == '__main__':
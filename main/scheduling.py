@@ -4,8 +4,25 @@ among the worker nodes
 """
 import time
 import urllib2
+import httplib
+from heapq import heappush, heappop
+from math import ceil
+from multiprocessing.pool import ThreadPool
+from novaclient import exceptions
 import predictor
-from manager import hack_url
+from cache import PredictionCache, model_signature
+from manager import worker_url
+
+# Seconds to wait for a worker to answer a status request, and the most
+# workers polled at once
+STATUS_TIMEOUT = 5
+POLL_THREADS = 32
+
+# Seconds between polls of /jobs/status while waiting for workers to finish.
+# When workers send completion events, polling is only a fallback in case an
+# event is lost, so it happens much less often
+POLL_INTERVAL = 5
+FALLBACK_POLL_INTERVAL = 60
 
 
 def time_until_deadline(deadline):
@@ -30,11 +47,11 @@ def time_until_deadline(deadline):
         print "Deadline required to be of form: MM/DD/YYYY HH:MM:SS"
 
 
-def partition(remaining, swift, container_name='videos', file_list=None):
-    """ Naive partitioning algorithm for figuring out which workloads can go
-    on each VM. This is done using the predict machine learning algorithm on
-    each of the files using the index file written earlier during the ingest
-    portion of the program.
+def greedy(jobs, capacity):
+    """ The original partitioning algorithm. Walks the jobs in order, adding
+    them to the current VM, and opens a new VM once the current one is full.
+    The job that fills a VM up is still added to it. Kept for comparison
+    against the other strategies.
 
     Note: I (the person writing the docstrings) did not create this
     algorithm, so am unsure exactly of what's going on here. The lines and
@@ -42,76 +59,225 @@ def partition(remaining, swift, container_name='videos', file_list=None):
     changes. Contact Ruben Madera (https://github.com/Roastmaster) for more
     info.
     """
-    if not file_list: 
-        container_data = []
-        for data in swift.get_container(container_name)[1]:
-            container_data.append('{0}\t{1}'.format(data['name'], data['bytes']))
-        container_data = [token.split('\t') for token in container_data]
-
-        # Use a list comprehension to create a list of all the file names
-        file_list = []
-        try:
-            file_list = [token[0] for token in container_data]
-        except IndexError:
-            print "IndexError: Container empty"
-    
     # Where we store the partitioned list of videos.
     # Internal lists separate what is possible to transcode in time on one VM
-    partitioned_video_list = []
+    bins = []
 
     # Given a time-until-completion by Joe's look up table, we keep
     # decrementing "time_until_deadline" by these times until it reaches
     # zero, then, create a new list (representing a new vm), and repeat.
-    tmp_t_u_d = remaining
-    print "Time Remaining:", predictor.prettify_time(remaining)
+    tmp_t_u_d = capacity
     single_vm_capacity = []
-    for video in file_list:
-        single_vm_capacity.append(video)
-        prediction_time = predictor.predict(video)
-        if prediction_time > remaining:
+    for i, (video, prediction_time) in enumerate(jobs):
+        single_vm_capacity.append((video, prediction_time))
+        if prediction_time > capacity:
             print "WARNING:  File is too big to be transcoded by VM in time."
-            partitioned_video_list.append(single_vm_capacity)
+            bins.append(single_vm_capacity)
             single_vm_capacity = []
             tmp_t_u_d -= prediction_time
             continue
 
         if tmp_t_u_d - prediction_time > 0:
             tmp_t_u_d -= prediction_time
-            if video == file_list[-1]:
-                partitioned_video_list.append(single_vm_capacity)
+            if i == len(jobs) - 1:
+                bins.append(single_vm_capacity)
 
         else:
-            tmp_t_u_d = remaining
-            partitioned_video_list.append(single_vm_capacity)
+            tmp_t_u_d = capacity
+            bins.append(single_vm_capacity)
             single_vm_capacity = []
 
-    return partitioned_video_list
+    return bins
+
+
+def first_fit_decreasing(jobs, capacity):
+    """ Bin packing by first fit decreasing. Jobs are taken longest first,
+    and each one goes on the first VM that still has room for it before the
+    deadline, opening a new VM only if none does. Jobs that can't finish in
+    time on any VM get a VM of their own.
+    """
+    bins = []
+    loads = []
+    for job in sorted(jobs, key=lambda job: job[1], reverse=True):
+        if job[1] > capacity:
+            print "WARNING:  File is too big to be transcoded by VM in time."
+
+        for i, load in enumerate(loads):
+            if load + job[1] <= capacity:
+                bins[i].append(job)
+                loads[i] += job[1]
+                break
+        else:
+            bins.append([job])
+            loads.append(job[1])
+
+    return bins
+
+
+def longest_processing_time(jobs, capacity):
+    """ Makespan scheduling by longest processing time first. Starting from
+    the fewest VMs that could possibly fit the total work before the
+    deadline, jobs are taken longest first and each is given to the least
+    loaded VM. If the busiest VM would then miss the deadline, this is
+    retried with one more VM. Jobs that can't finish in time on any VM get a
+    VM of their own.
+    """
+    too_big = [job for job in jobs if job[1] > capacity]
+    jobs = sorted([job for job in jobs if job[1] <= capacity],
+                  key=lambda job: job[1], reverse=True)
+    for job in too_big:
+        print "WARNING:  File is too big to be transcoded by VM in time."
+
+    bins = []
+    if jobs:
+        num_vms = max(1, int(ceil(sum(job[1] for job in jobs) / capacity)))
+        while True:
+            bins = [[] for i in range(num_vms)]
+            heap = [(0.0, i) for i in range(num_vms)]
+            for job in jobs:
+                load, i = heappop(heap)
+                bins[i].append(job)
+                heappush(heap, (load + job[1], i))
+            if max(heap)[0] <= capacity or num_vms >= len(jobs):
+                break
+            num_vms += 1
+
+    return bins + [[job] for job in too_big]
+
+
+# Strategies that partition can use to split up the workload. Each takes a
+# list of (filename, predicted time) pairs and the time until the deadline,
+# and returns a list of such lists, one per VM
+STRATEGIES = {
+    'greedy': greedy,
+    'ffd': first_fit_decreasing,
+    'lpt': longest_processing_time
+}
+
+
+def schedule_jobs(jobs, capacity, strategy='ffd'):
+    """ Splits a list of (filename, predicted time) pairs across VMs that
+    each have capacity seconds until the deadline, using one of the
+    STRATEGIES. Returns the list of workloads (one list of filenames per VM)
+    along with the predicted completion time of each VM. The number of VMs
+    needed is the length of either list.
+    """
+    bins = STRATEGIES[strategy](jobs, capacity)
+    bins = [vm_jobs for vm_jobs in bins if vm_jobs]
+    workloads = [[filename for filename, time_est in vm_jobs]
+                 for vm_jobs in bins]
+    completion_times = [sum(time_est for filename, time_est in vm_jobs)
+                        for vm_jobs in bins]
+    return workloads, completion_times
+
+
+def list_videos(swift, container_name='videos'):
+    """ Lists the videos in a swift container, returning a dictionary of the
+    form {filename: size in bytes}
+    """
+    return dict((data['name'], data['bytes'])
+                for data in swift.get_container(container_name)[1])
+
+
+def predict_jobs(file_list):
+    """ Predicts the transcode time of every file in the list, returning a
+    list of (filename, predicted time) pairs. Every file is scored in one
+    batch so the model and index are only loaded once, rather than once per
+    file. Predictions from previous runs are reused as long as the config and
+    models haven't changed
+    """
+    config = predictor.load_config()
+    cache = PredictionCache(model_signature(config))
+    predictions = predictor.predict_many(file_list, config=config, cache=cache)
+    return zip(file_list, predictions)
+
+
+def partition(remaining, swift, container_name='videos', file_list=None,
+              strategy='ffd'):
+    """ Partitioning algorithm for figuring out which workloads can go on
+    each VM. This is done using the predict machine learning algorithm on
+    each of the files using the index written earlier during the ingest
+    portion of the program, and then splitting the predicted times up using
+    one of the scheduling STRATEGIES. Returns a list of workloads, one per VM.
+    """
+    if not file_list:
+        file_list = list_videos(swift, container_name).keys()
+        if not file_list:
+            print "Container empty"
+
+    print "Time Remaining:", predictor.prettify_time(remaining)
+    workloads, completion_times = schedule_jobs(predict_jobs(file_list),
+                                                remaining, strategy)
+    print 'Scheduled %d files on %d VMs using %s' % \
+        (len(file_list), len(workloads), strategy)
+    for i, completion_time in enumerate(completion_times):
+        print 'VM #%d predicted to finish in about %s' % \
+            (i, predictor.prettify_time(completion_time))
+
+    return workloads
+
+
+def server_status(nova_client, server, loc, timeout=STATUS_TIMEOUT):
+    """ Asks a single server whether it has finished all of its jobs. Returns
+    True or False, or None if the server couldn't be reached in time, gave
+    a broken answer, or nova couldn't tell us its address
+    """
+    try:
+        # /jobs/status is where the REST API listens for requests about
+        # transcode jobs being complete. It just returns 'True' or 'False' if
+        # the job is done or not, so it's easy to check without any fancy
+        # HTML parsing
+        url = worker_url(nova_client, server, loc, '/jobs/status')
+        website = urllib2.urlopen(url, timeout=timeout)
+        return "True" == website.read().strip()
+    except (IOError, httplib.HTTPException, exceptions.ClientException) as e:
+        print 'Could not get status of server %s: %s' % (server.id, e)
+        return None
+
+
+def poll_status(nova_client, server_list, loc, timeout=STATUS_TIMEOUT):
+    """ Asks every server in the server_list for its status at the same time,
+    each request giving up after timeout seconds, so a poll takes about one
+    round trip no matter how many servers there are and a hung server can't
+    hold up the rest. Returns a dictionary of the form
+    {server id: True, False, or None if unreachable}
+    """
+    if not server_list:
+        return dict()
+
+    pool = ThreadPool(min(POLL_THREADS, len(server_list)))
+    statuses = pool.map(lambda server: server_status(nova_client, server, loc,
+                                                     timeout), server_list)
+    pool.close()
+    pool.join()
+    return dict(zip([server.id for server in server_list], statuses))
 
 
 def transcode_complete(nova_client, server_list, loc):
     """ The worker image has a function on /jobs/status that knows whether or
     not all of the jobs sent to it have been completed or not based off the
     number of files sent, and the number of files that have been placed back
-    in swift. This function calls that for every server int he server_list,
+    in swift. This function polls that for every server in the server_list,
     and if they are all done, it returns true, and otherwise returns false
     """
-    for index, server in enumerate(server_list):
-        # Finds the IP address of each of the server
-        addr_keys = nova_client.servers.ips(server).keys()[0]
-        ip_address = nova_client.servers.ips(server)[addr_keys][0]['addr']\
-            .encode('ascii')
-
-        # Creates the URL. /jobs/status is where the REST API listens for
-        # requests about transcode jobs being complete
-        url = "http://" + ip_address + ':5000/jobs/status'
-
-        # Voodoo demo magic
-        if loc == 'local':
-            url = hack_url(url)
-
-        # /jobs/status just returns 'True' or 'False' if the job is done or
-        # not, so it's easy to check without any fancy HTML parsing
-        website = urllib2.urlopen(url)
-        if "False" == website.read().strip():
-            return False
-    return True
+    statuses = poll_status(nova_client, server_list, loc)
+    return all(status is True for status in statuses.values())
+
+
+def wait_for_completion(nova_client, server_list, loc, tracker=None):
+    """ Blocks until every server in the server_list has finished its work.
+    If a CompletionTracker is given (see dispatch.py), this wakes up as soon
+    as the last server reports in, and only polls the servers every
+    FALLBACK_POLL_INTERVAL seconds in case a report went missing. Otherwise
+    the servers are polled every POLL_INTERVAL seconds
+    """
+    server_ids = [server.id for server in server_list]
+    while True:
+        if tracker:
+            if tracker.wait(server_ids, FALLBACK_POLL_INTERVAL):
+                return
+        else:
+            time.sleep(POLL_INTERVAL)
+
+        if transcode_complete(nova_client, server_list, loc):
+            return
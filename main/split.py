@@ -0,0 +1,189 @@
+""" COPYRIGHT Cisco Systems, Inc. 2015
+Split mode, for videos too long to be transcoded by a single VM before the
+deadline. Setting "SPLIT": true in local.json has the manager cut every file
+predicted to take longer than SPLIT_JOB_TIME seconds (by default half the
+time until the deadline) into time ranges, which are scheduled like any
+other job and so can be spread over as many VMs as the deadline needs.
+
+A chunk is a job named '<filename>|<start>|<duration>', in seconds. The
+worker downloads the source under a name of its own for the chunk (see
+local_name) and transcodes only that range of it. Chunks are cut at
+keyframes, estimated from the number of I frames in the index, since the
+exact keyframe times aren't stored.
+
+Once the outputs are retrieved, stitch joins the HLS output of each chunk
+into a single playlist in a directory named after the original file, with
+the segments of each chunk marked as a discontinuity.
+"""
+from math import ceil
+import tarfile
+import shutil
+import os
+
+# Fraction of the time until the deadline a single job may take before the
+# file is split, unless SPLIT_JOB_TIME is given
+DEFAULT_SPLIT_FRACTION = 0.5
+
+# Chunks are never made shorter than this many seconds of video
+MIN_CHUNK_DURATION = 60.0
+
+
+def job_name(filename, start, duration):
+    """ Name of the job transcoding duration seconds of a file from start """
+    return '%s|%.3f|%.3f' % (filename, start, duration)
+
+
+def parse_job(job):
+    """ Splits a job into the name of its source file, and the start and
+    duration of the range to transcode, which are None for a whole file
+    """
+    parts = job.split('|')
+    if len(parts) != 3:
+        return job, None, None
+    return parts[0], float(parts[1]), float(parts[2])
+
+
+def local_name(job):
+    """ Name a worker gives the downloaded source of a job, so several
+    chunks of one file never share a name, e.g. 'clip_part00120000.mp4' for
+    the chunk starting 120 seconds into 'clip.mp4'
+    """
+    filename, start, duration = parse_job(job)
+    if start is None:
+        return filename
+    root, extension = os.path.splitext(filename)
+    return '%s_part%08d%s' % (root, int(round(start * 1000)), extension)
+
+
+def chunk_ranges(duration, num_chunks, gop=None):
+    """ Splits duration seconds into num_chunks (start, duration) ranges of
+    about the same length, each starting on a multiple of gop seconds, the
+    estimated keyframe interval
+    """
+    target = duration / num_chunks
+    starts = []
+    for i in range(num_chunks):
+        start = i * target
+        if gop:
+            start = round(start / gop) * gop
+        if start < duration and (not starts or start > starts[-1]):
+            starts.append(start)
+    ends = starts[1:] + [duration]
+    return [(start, end - start) for start, end in zip(starts, ends)]
+
+
+def split_jobs(jobs, index, sizes, max_job_time):
+    """ Splits every (filename, predicted time) job predicted to take longer
+    than max_job_time into chunks, predicted to take a share of the time in
+    proportion to their share of the video. Every chunk downloads the whole
+    source, so it counts as the full size of its file.
+
+    Returns the new list of jobs, a copy of sizes that includes the chunks,
+    and a dictionary from each split file to its chunk jobs
+    """
+    split = []
+    sizes = dict(sizes)
+    chunks = dict()
+    for filename, time_est in jobs:
+        info = index.get(filename)
+        if time_est <= max_job_time or not info or not info['duration']:
+            split.append((filename, time_est))
+            continue
+
+        duration = float(info['duration'])
+        num_chunks = int(min(ceil(time_est / max_job_time),
+                             max(1, duration // MIN_CHUNK_DURATION)))
+        if num_chunks < 2:
+            split.append((filename, time_est))
+            continue
+
+        gop = duration / info['i frames'] if info.get('i frames') else None
+        chunks[filename] = []
+        for start, length in chunk_ranges(duration, num_chunks, gop):
+            job = job_name(filename, start, length)
+            chunks[filename].append(job)
+            split.append((job, time_est * length / duration))
+            sizes[job] = sizes.get(filename, 0)
+
+        print 'Splitting %s into %d chunks' % (filename,
+                                               len(chunks[filename]))
+    return split, sizes, chunks
+
+
+def chunk_output(job, directory='.'):
+    """ Returns the directory holding the retrieved HLS output of a chunk,
+    extracting its tarball first if it was placed as one
+    """
+    base = os.path.splitext(local_name(job))[0]
+    output_dir = os.path.join(directory, base)
+    archive_name = os.path.join(directory, base + '.tar')
+    if os.path.isfile(archive_name):
+        archive = tarfile.open(archive_name)
+        archive.extractall(output_dir)
+        archive.close()
+        os.remove(archive_name)
+    return output_dir
+
+
+def stitch(filename, jobs, directory='.'):
+    """ Joins the retrieved HLS output of the chunks of a file into one
+    playlist, '<base>/<base>.m3u8'. The segments of every chunk are moved
+    next to it in order, each chunk after the first is marked with
+    #EXT-X-DISCONTINUITY, and the target duration is the longest of any
+    chunk. Raises an IOError if a chunk has segments its playlist doesn't
+    list, rather than leave them out of the result. Returns the name of the
+    playlist
+    """
+    base = os.path.splitext(filename)[0]
+    output_dir = os.path.join(directory, base)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # Every chunk is checked before anything is moved, so a bad chunk leaves
+    # all of the retrieved output as it was
+    chunk_playlists = []
+    for job in sorted(jobs, key=lambda job: parse_job(job)[1]):
+        chunk_dir = chunk_output(job, directory)
+        playlists = [name for name in os.listdir(chunk_dir)
+                     if name.endswith('.m3u8')]
+        if not playlists:
+            raise IOError('No playlist found for chunk ' + job)
+
+        with open(os.path.join(chunk_dir, playlists[0]), 'r') as playlist:
+            lines = [line.strip() for line in playlist]
+        listed = set(line for line in lines
+                     if line and not line.startswith('#'))
+        unlisted = [name for name in os.listdir(chunk_dir)
+                    if name.endswith('.ts') and name not in listed]
+        if unlisted:
+            raise IOError('Playlist of chunk %s is missing %d of its '
+                          'segments' % (job, len(unlisted)))
+        chunk_playlists.append((chunk_dir, lines))
+
+    target_duration = 0
+    entries = []
+    for i, (chunk_dir, lines) in enumerate(chunk_playlists):
+        if i > 0:
+            entries.append('#EXT-X-DISCONTINUITY')
+        for line in lines:
+            if line.startswith('#EXT-X-TARGETDURATION:'):
+                target_duration = max(target_duration,
+                                      int(line.split(':')[1]))
+            elif line.startswith('#EXTINF:'):
+                entries.append(line)
+            elif line and not line.startswith('#'):
+                shutil.move(os.path.join(chunk_dir, line),
+                            os.path.join(output_dir, line))
+                entries.append(line)
+        shutil.rmtree(chunk_dir)
+
+    playlist_name = os.path.join(output_dir, os.path.basename(base) + '.m3u8')
+    with open(playlist_name, 'w') as playlist:
+        playlist.write('\n'.join(['#EXTM3U',
+                                  '#EXT-X-VERSION:3',
+                                  '#EXT-X-TARGETDURATION:%d' % target_duration,
+                                  '#EXT-X-MEDIA-SEQUENCE:0'] +
+                                 entries + ['#EXT-X-ENDLIST']) + '\n')
+    print 'Stitched %d chunks of %s into %s' % (len(jobs), filename,
+                                                playlist_name)
+    return playlist_name
@@ -0,0 +1,20 @@
+""" COPYRIGHT Cisco Systems, Inc. 2015
+The small JSON files the manager keeps between runs, such as the warm pool
+(pool.json) and the catalog of flavors and images (catalog.json)
+"""
+import json
+
+
+def load_state(filename):
+    """ Loads a state file, which is empty if it has never been saved """
+    try:
+        with open(filename, 'r') as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return dict()
+
+
+def save_state(state, filename):
+    """ Saves a state file """
+    with open(filename, 'w+') as state_file:
+        json.dump(state, state_file, sort_keys=True, indent=4)
@@ -0,0 +1,135 @@
+""" COPYRIGHT Cisco Systems, Inc. 2015
+SQLite backed store for the index generated during ingest. Every file gets
+one row, so adding or looking up a file doesn't require reading or rewriting
+the rest of the index the way index.json did. The old index.json format can
+still be imported and exported, either from other modules or by running
+'./store.py import index.json' or './store.py export index.json'. A new
+store automatically imports index.json if one is found next to it.
+"""
+import sqlite3
+import json
+import os
+import sys
+
+# Maps the keys of an index dictionary to the columns they are stored in
+COLUMNS = [('duration', 'duration', 'REAL'),
+           ('fps', 'fps', 'REAL'),
+           ('i frames', 'i_frames', 'INTEGER'),
+           ('b frames', 'b_frames', 'INTEGER'),
+           ('p frames', 'p_frames', 'INTEGER'),
+           ('width', 'width', 'INTEGER'),
+           ('height', 'height', 'INTEGER'),
+           ('format', 'format', 'TEXT'),
+           ('v codec', 'v_codec', 'TEXT'),
+           ('a codec', 'a_codec', 'TEXT')]
+
+# SQLite limits the number of parameters in a single query, so batch reads
+# are split into chunks of this many filenames
+BATCH_SIZE = 500
+
+
+def connect(db_filename='index.db', json_filename='index.json'):
+    """ Opens the index store, creating it if needed. A newly created store
+    imports the json index if it exists, so existing catalogs carry over
+    """
+    new = not os.path.exists(db_filename)
+    conn = sqlite3.connect(db_filename)
+    columns = ', '.join(column + ' ' + sql_type
+                        for key, column, sql_type in COLUMNS)
+    conn.execute('CREATE TABLE IF NOT EXISTS videos ('
+                 'filename TEXT PRIMARY KEY, ' + columns + ', extra TEXT)')
+    if new and os.path.exists(json_filename):
+        print 'Importing', json_filename, 'into', db_filename
+        import_json(conn, json_filename)
+    return conn
+
+
+def row_to_entry(row):
+    """ Turns a (filename, *columns, extra) row back into an index entry """
+    entry = dict((key, value) for (key, column, sql_type), value
+                 in zip(COLUMNS, row[1:-1]))
+    if row[-1]:
+        entry.update(json.loads(row[-1]))
+    return entry
+
+
+def write_entries(conn, entries):
+    """ Inserts or replaces the index entries of a dictionary of the form
+    {filename: {*attributes*}}. Any attributes without a column of their own
+    are kept as json in the extra column.
+    """
+    known = set(key for key, column, sql_type in COLUMNS)
+    rows = []
+    for filename, entry in entries.iteritems():
+        extra = dict((key, value) for key, value in entry.iteritems()
+                     if key not in known)
+        rows.append([filename] +
+                    [entry.get(key) for key, column, sql_type in COLUMNS] +
+                    [json.dumps(extra, sort_keys=True) if extra else None])
+
+    placeholders = ', '.join('?' * (len(COLUMNS) + 2))
+    conn.executemany('INSERT OR REPLACE INTO videos VALUES (' + placeholders +
+                     ')', rows)
+    conn.commit()
+
+
+def write_entry(conn, filename, entry):
+    """ Inserts or replaces the index entry of a single file """
+    write_entries(conn, {filename: entry})
+
+
+def read_entry(conn, filename):
+    """ Returns the index entry of a single file, raising a KeyError if the
+    file was never ingested
+    """
+    row = conn.execute('SELECT * FROM videos WHERE filename = ?',
+                       (filename,)).fetchone()
+    if row is None:
+        raise KeyError(filename)
+    return row_to_entry(row)
+
+
+def read_entries(conn, filenames=None):
+    """ Returns a dictionary of the form {filename: {*attributes*}} for the
+    given filenames, or for every file in the store if none are given. This
+    is how the scheduler reads all of its feature rows at once.
+    """
+    if filenames is None:
+        rows = conn.execute('SELECT * FROM videos').fetchall()
+    else:
+        filenames = list(filenames)
+        rows = []
+        for start in range(0, len(filenames), BATCH_SIZE):
+            batch = filenames[start:start + BATCH_SIZE]
+            rows += conn.execute('SELECT * FROM videos WHERE filename IN (' +
+                                 ', '.join('?' * len(batch)) + ')',
+                                 batch).fetchall()
+    return dict((row[0], row_to_entry(row)) for row in rows)
+
+
+def import_json(conn, json_filename='index.json'):
+    """ Imports an index json file of the format written by older versions
+    of ingest.py into the store
+    """
+    with open(json_filename, 'r') as index_file:
+        write_entries(conn, json.load(index_file))
+
+
+def export_json(conn, json_filename='index.json'):
+    """ Exports the store to an index json file, in the same format older
+    versions of ingest.py wrote
+    """
+    with open(json_filename, 'w+') as index_file:
+        json.dump(read_entries(conn), index_file, sort_keys=True, indent=4)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ('import', 'export'):
+        print 'Usage: ./store.py import|export index.json'
+        sys.exit(1)
+
+    index_store = connect()
+    if sys.argv[1] == 'import':
+        import_json(index_store, sys.argv[2])
+    else:
+        export_json(index_store, sys.argv[2])
@@ -1,32 +1,58 @@
 """ COPYRIGHT Cisco Systems, Inc. 2015
 This file is automatically run on each of the worker nodes when the image
 boots up, contains all functions for transcoding, and contains the REST API.
-There are 3 main threads in this program, the grab thread, the convert
-thread, and the place thread.
+There are 3 main kinds of threads in this program, the grab thread, the
+convert threads, and the place thread.
 
 The grab thread continuously grabs files from swift, based of the grab queue.
 When it finishes grabbing it from swift, it places it in the convert queue.
 
-The convert thread continuously listens to the convert queue, and whenever
-something gets placed in it, it converts it. When it is finished converting
-it, it tars all of the associated files, and puts them in the place queue.
+The convert threads continuously listen to the convert queue, and whenever
+something gets placed in it, one of them converts it. When it is finished
+converting it, it tars all of the associated files, and puts them in the
+place queue. Several convert threads run at once (see CONVERT_WORKERS), so
+small files can be transcoded side by side.
 
 The place thread continuously listens to the place queue, and whenever
-something gets put in it, it places it back into swift. All of these threads
+something gets put in it, it places it back into swift. With "output_mode":
+"segments" in transcode.json, the output isn't tar'd. Each HLS segment is
+uploaded by a SegmentUploader while ffmpeg is still encoding, and the place
+thread only uploads the last segments and the playlist. With "tar_stream",
+the place thread streams the tarball straight into swift without writing it
+to disk. All of these threads
 run simultaneously, such that time won't be wasted when one thread or another
 is backed up.
 
+Instead of being POSTed a fixed workload, a worker can also be told to pull
+its jobs from the manager (see dispatch.py). A pull thread then asks the
+manager for a new file whenever a convert thread frees up, and feeds it to
+the grab queue.
+
+If the manager sends a notify URL along with the work, the worker POSTs an
+event to it every time a file is placed back in swift, and once more when
+all of its work is done, so the manager doesn't have to wait for its next
+poll of /jobs/status.
+
 Note: Many areas of this file don't have comments, as it was thought the
 print statements sufficiently explain what each section of the code is doing.
 Read those in lieu of comments.
 """
-from threading import Thread
+from threading import Thread, Lock, Semaphore, Event
+from multiprocessing import cpu_count
 from Queue import Queue
+from urllib import urlencode
+from time import sleep
+import urllib2
+import subprocess
 import tarfile
+import shutil
 import os
 from flask import *
 from converter import ffmpeg
+from swiftclient import ClientException
 from clients import create_swift_client
+from move import download, upload, upload_stream, with_retries
+from split import parse_job, local_name
 
 
 # Global variables required for the REST API
@@ -43,6 +69,51 @@ placeQ = Queue()
 num_total = 0
 num_processed = 0
 
+# Number of parallel range requests used to grab large videos from swift
+DOWNLOAD_RANGES = 4
+
+# Number of convert threads, each running its own ffmpeg. Can be overridden
+# with 'convert_workers' in transcode.json. Unless 'threads' is set there,
+# the cores are split evenly between the ffmpeg processes
+CONVERT_WORKERS = max(1, cpu_count() // 2)
+
+# The worker threads are started by the first POST to /jobs and are reused
+# by every later one
+pipeline_started = False
+pipeline_lock = Lock()
+
+# Global variables for pull mode. A job is only pulled when one of the
+# convert_slots is free, and there is one slot per convert thread plus
+# PREFETCH extra, so the next file can be grabbed while the current ones
+# are converting
+PREFETCH = 1
+pulling = False
+pull_exhausted = False
+convert_slots = None
+
+# How the transcoded output is placed in swift, set with 'output_mode' in
+# transcode.json. 'tar' uploads a tarball of the whole output once ffmpeg is
+# done, and 'tar_stream' does the same without ever writing the tarball to
+# disk. 'segments' uploads every HLS segment as soon as ffmpeg has finished
+# writing it, checking every SEGMENT_POLL_INTERVAL seconds, and uploads the
+# playlist once the encode is over
+DEFAULT_OUTPUT_MODE = 'tar'
+SEGMENT_POLL_INTERVAL = 1
+CONTENT_TYPES = {'.ts': 'video/MP2T',
+                 '.m3u8': 'application/vnd.apple.mpegurl'}
+
+# A streamed tarball can't be resent from where it failed, so a failed
+# upload is started over with a fresh archive, up to this many more times
+STREAM_RETRIES = 3
+
+# Global variables for completion notifications. Nothing counts as done
+# until some work has actually been posted
+work_posted = False
+notify_url = None
+worker_id = None
+workload_notified = False
+notify_lock = Lock()
+
 
 @app.route('/')
 def index():
@@ -76,15 +147,8 @@ def jobs():
         # After it downloads the file, which *should* be a list of swift
         # files, it fills the grab queue
         fill_grabQ(swift_files)
-
-        print 'Spawning grab thread'
-        Thread(target=grab_thread).start()
-
-        print 'Spawning convert thread'
-        Thread(target=convert_thread).start()
-
-        print 'Spawning place thread'
-        Thread(target=place_thread).start()
+        accept_work(request.form)
+        start_pipeline()
         return ''
 
     else:
@@ -93,16 +157,168 @@ def jobs():
         return print_all_queues()
 
 
+@app.route('/jobs/pull', methods=['POST'])
+def pull():
+    """ Puts the worker in pull mode. The POST has the URL of the manager's
+    dispatcher, the name of the queue to pull from, and an id for this
+    worker. Starts the pull thread along with the usual worker threads
+    """
+    global pulling, convert_slots
+    print 'Accessed POST method on /jobs/pull'
+
+    pulling = True
+    convert_slots = Semaphore(convert_workers() + PREFETCH)
+    accept_work(request.form)
+    Thread(target=pull_thread, args=(request.form['dispatcher'],
+                                     request.form['queue'],
+                                     request.form['worker'])).start()
+    start_pipeline()
+    return ''
+
+
 @app.route('/jobs/status')
 def completed():
     """ Simple function that checks whether or not the number of total jobs
     matches the number of processed jobs. If so, then the worker is finished
-    with all its work, and returns a completed status.
+    with all its work, and returns a completed status. In pull mode, the
+    manager must also have run out of jobs to hand out.
     """
-    global num_processed, num_total
     print 'Accessed /jobs/status'
     print 'Jobs remaining: ' + str(num_total - num_processed)
-    return str(num_processed == num_total)
+    return str(all_done())
+
+
+@app.route('/reset', methods=['POST'])
+def reset():
+    """ Clears the state left over from the last workload, so the worker can
+    be reused by a later run of the manager (see pool.py). The worker threads
+    keep running. Refuses with a 409 if the worker is still busy
+    """
+    global num_total, num_processed, work_posted, pulling, pull_exhausted
+    global workload_notified, notify_url, worker_id
+    print 'Accessed POST method on /reset'
+
+    with notify_lock:
+        if work_posted and not all_done():
+            return 'Busy', 409
+        num_total = 0
+        num_processed = 0
+        work_posted = False
+        pulling = False
+        pull_exhausted = False
+        workload_notified = False
+        notify_url = None
+        worker_id = None
+    return 'True'
+
+
+def all_done():
+    """ True once work has been posted and all of it has been placed back in
+    swift. In pull mode, the manager must also have run out of jobs
+    """
+    return (work_posted and num_processed == num_total and
+            (not pulling or pull_exhausted))
+
+
+def accept_work(form):
+    """ Records that work has been posted, along with where to send
+    completion events to and the id of this worker, if the manager sent them
+    """
+    global work_posted, notify_url, worker_id, workload_notified
+
+    with notify_lock:
+        notify_url = form.get('notify') or notify_url
+        worker_id = form.get('worker') or worker_id
+        workload_notified = False
+        work_posted = True
+
+
+def notify(event, **details):
+    """ POSTs a completion event to the manager, if it asked for them. This
+    is best effort, as the manager still falls back on polling /jobs/status
+    """
+    if not notify_url:
+        return
+    details.update({'event': event, 'worker': worker_id})
+    try:
+        notification = urllib2.Request(notify_url, json.dumps(details),
+                                       {'Content-Type': 'application/json'})
+        urllib2.urlopen(notification, timeout=5).read()
+    except IOError as e:
+        print 'Could not notify manager of %s event: %s' % (event, e)
+
+
+def notify_if_done():
+    """ Sends the workload event the first time all of the work is done """
+    global workload_notified
+
+    with notify_lock:
+        if workload_notified or not all_done():
+            return
+        workload_notified = True
+    notify('workload', processed=num_processed)
+
+
+def convert_workers(config=None):
+    """ Number of convert threads to run, see CONVERT_WORKERS """
+    if not config:
+        config = read_config()
+    return config.get('convert_workers', CONVERT_WORKERS)
+
+
+def start_pipeline():
+    """ Starts the grab thread, the convert threads and the place thread, if
+    they haven't been started already
+    """
+    global pipeline_started
+
+    with pipeline_lock:
+        if pipeline_started:
+            return
+        pipeline_started = True
+
+    num_converters = convert_workers()
+
+    print 'Spawning grab thread'
+    Thread(target=grab_thread).start()
+
+    for i in range(num_converters):
+        print 'Spawning convert thread #' + str(i)
+        Thread(target=convert_thread).start()
+
+    print 'Spawning place thread'
+    Thread(target=place_thread).start()
+
+
+def pull_thread(dispatcher_url, queue, worker_id):
+    """ Defines the pull thread, which keeps asking the manager for the next
+    job whenever a convert slot is free, and puts it in the grab queue. Stops
+    once the manager answers with no job
+    """
+    global grabQ, num_total, pull_exhausted
+
+    url = dispatcher_url + '/jobs/next?' + urlencode({'queue': queue,
+                                                      'worker': worker_id})
+    while True:
+        convert_slots.acquire()
+        print 'PULL THREAD: Asking manager for the next job'
+        try:
+            filename = urllib2.urlopen(url, timeout=30).read().strip()
+        except IOError as e:
+            print 'PULL THREAD: Could not reach manager (%s), retrying' % e
+            convert_slots.release()
+            sleep(5)
+            continue
+
+        if not filename:
+            print 'PULL THREAD: No jobs left on the manager'
+            pull_exhausted = True
+            notify_if_done()
+            return
+
+        print 'PULL THREAD: Adding ' + filename + ' to grab queue'
+        num_total += 1
+        grabQ.put(filename)
 
 
 def grab_thread():
@@ -129,17 +345,34 @@ def grab_thread():
 
 
 def convert_thread():
-    """ Defines the convert thread, which has an infinite loop in it that keeps
-    listening and converting items from the convert queue
+    """ Defines a convert thread, which has an infinite loop in it that keeps
+    listening and converting items from the convert queue. Queue.get is
+    thread safe, so any number of these can share the convert queue and each
+    file is only ever handed to one of them
     """
-    global convertQ, placeQ
+    global convertQ, placeQ, num_processed
 
     while True:
         print 'CONVERT THREAD: Listening on convert queue'
         filename = convertQ.get()
 
         print 'CONVERT THREAD: Converting ' + filename
-        new_name = convert(filename)
+        try:
+            new_name = convert(filename)
+        except Exception as e:
+            # A failed encode counts as processed, with no output, so the
+            # thread lives on and the worker can still finish
+            print 'CONVERT THREAD: Could not convert %s: %s' % (filename, e)
+            new_name = None
+
+        # Frees up a slot so the pull thread can fetch another job
+        if pulling:
+            convert_slots.release()
+
+        if new_name is None:
+            num_processed += 1
+            notify_if_done()
+            continue
 
         print 'CONVERT THREAD: Putting ' + new_name + ' in place queue'
         placeQ.put(new_name)
@@ -162,9 +395,20 @@ def place_thread():
         filename = placeQ.get()
 
         print 'PLACE THREAD: Placing ' + filename + ' back in swift'
-        place(sw_client, filename)
+        try:
+            placed = place(sw_client, filename)
+        except Exception as e:
+            # A job that can't be placed still counts as processed, so the
+            # rest of the work isn't held up and the worker can finish. Its
+            # output is just missing from swift
+            print 'PLACE THREAD: Could not place %s: %s' % (filename, e)
+            placed = None
         num_processed += 1
 
+        if placed:
+            notify('job', **placed)
+        notify_if_done()
+
 
 def fill_grabQ(swift_urls):
     """ Fills the grab queue with items from the file POSTed to the /jobs URL
@@ -175,8 +419,8 @@ def fill_grabQ(swift_urls):
     with open(swift_urls, 'r+') as swift_url_list:
         for line in swift_url_list.readlines():
             print 'Adding ' + line.strip() + ' to grab queue'
+            num_total += 1
             grabQ.put(line.strip())
-    num_total = grabQ.qsize()
 
 
 def read_config(config_file='config/transcode.json'):
@@ -187,7 +431,7 @@ def read_config(config_file='config/transcode.json'):
         return json.load(json_config)
 
 
-def grab(sw_client, filename):
+def grab(sw_client, job):
     """ In order to interact with swift storage, we need credentials and we
     need to create an actual client with the swiftclient API this assumes
     several things:
@@ -195,45 +439,170 @@ def grab(sw_client, filename):
     2) clients.py and transburst_utils.py are in the current directory
     """
 
-    # Reminder: sw_client.get_object returns a tuple in the form of:
-    # (filename, file content)
-    vid_tuple = sw_client.get_object('videos', filename)
-
-    # Finally, write a file to the local directory with the same name as the
-    # file we are retrieving
-    with open(filename, 'wb') as new_vid:
-        new_vid.write(vid_tuple[1])
+    # Streams the object to a file in the local directory with the same name
+    # as the file we are retrieving, so the video never has to fit in memory.
+    # Large videos are fetched with several range requests at once. A chunk
+    # of a split file (see split.py) gets a name of its own
+    filename, start, duration = parse_job(job)
+    download(sw_client, 'videos', filename, local_name(job),
+             num_ranges=DOWNLOAD_RANGES)
 
 
 def place(sw_client, filename, container='completed', content_type='video'):
     """ Places a file into swift. Since this is only done on completed
     transcoded videos, the default container is 'completed', and the default
-    content type is 'videos'. This is of course easily generalizable
+    content type is 'videos'. This is of course easily generalizable. In the
+    'segments' and 'tar_stream' output modes, filename is instead the output
+    directory of an encode, which is placed by place_segments or stream_tar.
+    Returns the details of what was placed for the job event sent to the
+    manager
     """
     sw_client.put_container(container)
-    with open(filename, 'rb') as f:
-        sw_client.put_object(container, filename, contents=f,
-                             content_type=content_type)
+    if os.path.isdir(filename):
+        if output_mode() == 'tar_stream':
+            return stream_tar(sw_client, filename, container, content_type)
+        return place_segments(sw_client, filename, container)
+
+    upload(sw_client, container, filename, content_type=content_type)
     os.remove(filename)
+    return {'output': os.path.basename(filename)}
+
+
+def output_mode(config=None):
+    """ How the transcoded output is placed in swift, see DEFAULT_OUTPUT_MODE
+    """
+    if not config:
+        config = read_config()
+    return config.get('output_mode', DEFAULT_OUTPUT_MODE)
 
 
-def convert(filename, config=None):
+def finished_segments(output_dir, final=False):
+    """ Lists the HLS segments in an output directory that ffmpeg is done
+    with, in order. ffmpeg rewrites the playlist each time it closes a
+    segment, and with '-hls_list_size 0' the playlist lists every one of
+    them, so the segments it lists are exactly the finished ones. Once
+    ffmpeg has exited (final is set), every segment left is finished
+    """
+    names = os.listdir(output_dir)
+    present = set(name for name in names if name.endswith('.ts'))
+    finished = []
+    for playlist in sorted(name for name in names if name.endswith('.m3u8')):
+        with open(os.path.join(output_dir, playlist), 'r') as lines:
+            for line in lines:
+                if line.strip() in present and line.strip() not in finished:
+                    finished.append(line.strip())
+
+    if final:
+        finished += sorted(present.difference(finished))
+    return finished
+
+
+def upload_segments(sw_client, output_dir, prefix, container='completed',
+                    final=False):
+    """ Uploads the finished segments in an output directory under prefix,
+    and removes each one once it is in swift, so it is only uploaded once
+    """
+    for segment in finished_segments(output_dir, final):
+        path = os.path.join(output_dir, segment)
+        print 'Uploading segment ' + prefix + segment
+        upload(sw_client, container, path, name=prefix + segment,
+               content_type=CONTENT_TYPES['.ts'])
+        os.remove(path)
+
+
+def place_segments(sw_client, output_dir, container='completed'):
+    """ Places whatever the SegmentUploader of an encode left behind: the
+    last segments, then the playlist, which goes last so it never refers to
+    a segment that isn't in swift yet. The output directory is removed
+    """
+    prefix = os.path.basename(output_dir)[:-len('.out')] + '/'
+    upload_segments(sw_client, output_dir, prefix, container, final=True)
+
+    playlists = []
+    for name in sorted(os.listdir(output_dir)):
+        extension = os.path.splitext(name)[1]
+        if extension == '.m3u8':
+            playlists.append(name)
+            continue
+        upload(sw_client, container, os.path.join(output_dir, name),
+               name=prefix + name,
+               content_type=CONTENT_TYPES.get(extension, 'video'))
+
+    for name in playlists:
+        upload(sw_client, container, os.path.join(output_dir, name),
+               name=prefix + name, content_type=CONTENT_TYPES['.m3u8'])
+
+    shutil.rmtree(output_dir)
+    return {'output': prefix + playlists[-1] if playlists else prefix,
+            'prefix': prefix}
+
+
+class SegmentUploader(Thread):
+    """ Thread that uploads the HLS segments of one encode to swift while
+    ffmpeg is still writing the rest of them. It uses its own swift client,
+    since swift clients can't be shared between threads
+    """
+
+    def __init__(self, output_dir, prefix, container='completed'):
+        Thread.__init__(self)
+        self.daemon = True
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.container = container
+        self.done = Event()
+
+    def run(self):
+        credentials = json.load(open('config/local.json'))
+        sw_client = create_swift_client(credentials)
+        sw_client.put_container(self.container)
+
+        while not self.done.wait(SEGMENT_POLL_INTERVAL):
+            try:
+                upload_segments(sw_client, self.output_dir, self.prefix,
+                                self.container)
+            except Exception as e:
+                # Anything left over is uploaded by the place thread
+                print 'SEGMENT UPLOADER: Error uploading segments: %s' % e
+
+    def stop(self):
+        """ Stops the thread once ffmpeg is done, and waits for it to finish
+        the upload it is in the middle of
+        """
+        self.done.set()
+        self.join()
+
+
+def convert(job, config=None):
     """ Using python-video-converter as an ffmpeg wrapper, convert a
-    given file to match the given config. After this is done, all associated
-    files with the transcode are tar'd, as a transcode can generate an
-    arbitrary number of files for the HLS transcode format
+    given file to match the given config. The output is written to its own
+    directory, since several files can be converting at once. After this is
+    done, all files in that directory are tar'd, as a transcode can generate
+    an arbitrary number of files for the HLS transcode format. In the
+    'segments' output mode, the files are instead uploaded as they are
+    written, and the output directory is returned rather than a tarball.
+    For a chunk of a split file, only its time range is transcoded
     """
+    source, start, duration = parse_job(job)
+    filename = local_name(job)
 
     # If no config is passed, read in the default
     if not config:
         config = read_config()
 
     # Create the new name based off the new format (found in the config
-    # dictionary)
-    name_parts = filename.split('.')
-    base = name_parts[0]
+    # dictionary), inside the output directory for this file. Only the last
+    # extension is dropped, so 'my.clip.mp4' becomes 'my.clip', as the
+    # manager expects (see split.chunk_output)
+    base = os.path.splitext(filename)[0]
     form_type = config['format']
-    new_name = base + '.' + form_type
+    output_dir = base + '.out'
+
+    # A reused worker (see pool.py) may still have the output of an earlier
+    # run with the same name, which mustn't end up in this one
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    new_name = os.path.join(output_dir, base + '.' + form_type)
 
     # Although a dictionary is easiest to work with for entering
     # options from a human-readable point of view, the low-level ffmpeg
@@ -249,38 +618,135 @@ def convert(filename, config=None):
     if 'size' in config['video']:
         new_config += ['-s', config['video']['size']]
 
-    f = ffmpeg.FFMpeg()
-
-    # Creates the generator used to convert the file
-    c_gen = f.convert(filename, new_name, new_config, timeout=0)
-
-    # Not sure why, but this is the standard way to convert files using the
-    # python-video-converter framework. Just the way it is
-    for c in c_gen:
-        pass
-
-    # The old file is no longer needed, so it can be removed
-    os.remove(filename)
-
-    # The tar function will tar all data associated with the base name (that
-    # is, the name with no extension such as '.mp4'), and then will return
-    # the file name of the tar'd data
-    return tar(base)
+    # Limits how many threads each ffmpeg uses so the convert threads don't
+    # fight over the same cores
+    num_converters = convert_workers(config)
+    threads = config.get('threads', max(1, cpu_count() // num_converters))
+    new_config += ['-threads', str(threads)]
+
+    # ffmpeg's HLS playlists only list the last 5 segments by default. The
+    # segments output mode uploads and deletes every segment as soon as it is
+    # written, and the chunks of a split file are stitched together from
+    # their playlists, so both need every segment listed
+    mode = output_mode(config)
+    if mode == 'segments' or start is not None:
+        new_config += ['-hls_list_size', '0']
+
+    uploader = None
+    if mode == 'segments':
+        uploader = SegmentUploader(output_dir, base + '/')
+        uploader.start()
 
+    f = ffmpeg.FFMpeg()
 
-def tar(base):
-    """ Tar's all files associated with a base name. Does not delete old files
+    try:
+        if start is None:
+            # Creates the generator used to convert the file
+            c_gen = f.convert(filename, new_name, new_config, timeout=0)
+
+            # Not sure why, but this is the standard way to convert files
+            # using the python-video-converter framework. Just the way it is
+            for c in c_gen:
+                pass
+        else:
+            # python-video-converter puts every option after -i, where -ss
+            # makes ffmpeg decode everything before the chunk first. Given
+            # before -i, ffmpeg seeks straight to the chunk, which is still
+            # frame accurate since the video is re-encoded
+            subprocess.check_call([f.ffmpeg_path,
+                                   '-ss', '%.3f' % start, '-i', filename,
+                                   '-t', '%.3f' % duration] +
+                                  new_config + ['-y', new_name])
+    finally:
+        if uploader:
+            uploader.stop()
+
+        # The old file is no longer needed, even if the encode failed, so it
+        # can be removed
+        os.remove(filename)
+
+    # The segments are already on their way to swift, and a streamed tar is
+    # made by the place thread as it uploads, so in either case the output
+    # directory goes straight to the place thread
+    if mode in ('segments', 'tar_stream'):
+        return output_dir
+
+    # The tar function will tar all data in the output directory, and then
+    # will return the file name of the tar'd data
+    return tar(base, output_dir)
+
+
+def tar(base, output_dir):
+    """ Tar's all files in the output directory of a base name, and removes
+    the output directory once they are in the archive
     """
     print 'Writing tar archive as ' + base + '.tar'
     archive = tarfile.open(base + '.tar', 'w')
-    for filename in os.listdir('.'):
-        if base in filename:
-            print 'Adding ' + filename + ' to ' + base + '.tar'
-            archive.add(filename)
+    for filename in sorted(os.listdir(output_dir)):
+        print 'Adding ' + filename + ' to ' + base + '.tar'
+        archive.add(os.path.join(output_dir, filename), arcname=filename)
     archive.close()
+    shutil.rmtree(output_dir)
     return base + '.tar'
 
 
+def stream_tar(sw_client, output_dir, container='completed',
+               content_type='video', retries=STREAM_RETRIES):
+    """ Uploads a tar archive of all files in the output directory of an
+    encode as '<base>.tar', without writing the archive to disk. A thread
+    writes the archive into a pipe, and the other end of it is uploaded in
+    segments as it is read (see upload_stream), so the archive can be of any
+    size. If either side fails, the archive is written and uploaded again
+    from the start. The output directory is removed once it is uploaded
+    """
+    name = os.path.basename(output_dir)[:-len('.out')] + '.tar'
+    with_retries(lambda: stream_archive(sw_client, output_dir, name,
+                                        container, content_type),
+                 name, retries,
+                 (ClientException, IOError, OSError, tarfile.TarError))
+    shutil.rmtree(output_dir)
+    return {'output': name}
+
+
+def stream_archive(sw_client, output_dir, name, container='completed',
+                   content_type='video'):
+    """ Makes a single attempt at streaming the tar archive of an output
+    directory into swift for stream_tar. A truncated archive left by a
+    failed writer is removed before the error is raised
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def write_archive():
+        try:
+            with os.fdopen(write_fd, 'wb') as pipe:
+                archive = tarfile.open(fileobj=pipe, mode='w|')
+                for filename in sorted(os.listdir(output_dir)):
+                    print 'Streaming ' + filename + ' into ' + name
+                    archive.add(os.path.join(output_dir, filename),
+                                arcname=filename)
+                archive.close()
+        except (IOError, OSError, tarfile.TarError) as e:
+            errors.append(e)
+
+    writer = Thread(target=write_archive)
+    writer.start()
+    try:
+        # Closing the read end, even if the upload fails, makes the writer
+        # stop rather than block on a full pipe
+        with os.fdopen(read_fd, 'rb') as pipe:
+            upload_stream(sw_client, container, pipe, name, content_type)
+    finally:
+        writer.join()
+
+    # A failed writer just ends the upload early, so the truncated archive
+    # it leaves behind has to be removed, along with its segments
+    if errors:
+        sw_client.delete_object(container, name,
+                                query_string='multipart-manifest=delete')
+        raise errors[0]
+
+
 def print_all_queues():
     """ Converts all queues to lists and prints them out
     """